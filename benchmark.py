@@ -0,0 +1,345 @@
+"""
+Benchmarks for request building, response parsing and end-to-end throughput.
+
+    python benchmark.py                          # run everything, print a table
+    python benchmark.py --output run.json        # also store the results as JSON
+    python benchmark.py --compare base.json      # print the change against an earlier run
+    python benchmark.py --only parse --quick     # run the benchmarks whose name contains "parse", fewer repeats
+"""
+import argparse
+import BaseHTTPServer
+import json
+import os
+import platform
+import SocketServer
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from marketo import auth
+from marketo import Client
+from marketo.wrapper import exceptions
+from marketo.wrapper import get_lead
+from marketo.wrapper import get_lead_activity
+from marketo.wrapper import sync_lead
+
+USER_ID = "bigcorp1_461839624B16E06BA2D663"
+ENCRYPTION_KEY = "899756834129871744AAEE88DDCC77CDEEDEC1AAAD66"
+
+LEAD_SIZES = (10, 150, 500)
+ACTIVITY_SIZES = (10, 100, 1000, 10000)
+CONCURRENCY = (1, 4, 16)
+
+FAULT = '<?xml version="1.0" encoding="UTF-8"?>' \
+        '<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/">' \
+        '<SOAP-ENV:Body>' \
+        '<SOAP-ENV:Fault>' \
+        '<faultcode>SOAP-ENV:Client</faultcode>' \
+        '<faultstring>20103 - Lead not found</faultstring>' \
+        '<detail>' \
+        '<ns1:serviceException xmlns:ns1="http://www.marketo.com/mktows/">' \
+        '<name>mktServiceException</name>' \
+        '<message>No lead found with EMAIL = john@doe (20103)</message>' \
+        '<code>20103</code>' \
+        '</ns1:serviceException>' \
+        '</detail>' \
+        '</SOAP-ENV:Fault>' \
+        '</SOAP-ENV:Body>' \
+        '</SOAP-ENV:Envelope>'
+
+_ATTRIBUTE = "<attribute>" \
+             "<attrName>{name}</attrName>" \
+             "<attrType>{typ}</attrType>" \
+             "<attrValue>{value}</attrValue>" \
+             "</attribute>"
+
+
+def _attribute_values(count):
+    for i in xrange(count):
+        if i % 3 == 0:
+            yield "Score_%d__c" % i, "integer", str(i * 7)
+        elif i % 3 == 1:
+            yield "Custom_Field_%d__c" % i, "string", "Some value for field number %d" % i
+        else:
+            yield "Updated_At_%d__c" % i, "datetime", "2013-02-11T16:19:48-06:00"
+
+
+def _envelope(body):
+    return '<?xml version="1.0" encoding="UTF-8"?>' \
+           '<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/" ' \
+           'xmlns:ns1="http://www.marketo.com/mktows/">' \
+           '<SOAP-ENV:Body>%s</SOAP-ENV:Body>' \
+           '</SOAP-ENV:Envelope>' % body
+
+
+def lead_response(attributes):
+    """
+    A getLead response with one lead record carrying the given number of attributes.
+    """
+    attrs = "".join(_ATTRIBUTE.format(name=name, typ=typ, value=value)
+                    for name, typ, value in _attribute_values(attributes))
+    return _envelope("<ns1:successGetLead><result><count>1</count><leadRecordList><leadRecord>"
+                     "<Id>384563</Id><Email>john@doe.com</Email>"
+                     "<leadAttributeList>%s</leadAttributeList>"
+                     "</leadRecord></leadRecordList></result></ns1:successGetLead>" % attrs)
+
+
+def activity_response(records):
+    """
+    A getLeadActivity response with the given number of activity records, eight attributes each.
+    """
+    activities = []
+    for i in xrange(records):
+        attrs = "".join(_ATTRIBUTE.format(name=name, typ=typ, value=value) for name, typ, value in
+                        (("Webpage ID", "integer", str(i)),
+                         ("Webpage URL", "string", "/pricing/%d" % i),
+                         ("Query Parameters", "string", ""),
+                         ("Referrer URL", "string", "https://company.com/appointments/"),
+                         ("Client IP Address", "string", "61.183.85.141"),
+                         ("User Agent", "string", "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_8_2)"),
+                         ("Lead ID", "integer", "1474562"),
+                         ("Created At", "string", "2013-02-11 16:19:48")))
+        activities.append("<activityRecord>"
+                          "<id>%d</id>"
+                          "<activityDateTime>2013-02-11T16:19:48-06:00</activityDateTime>"
+                          "<activityType>Visit Webpage</activityType>"
+                          "<mktgAssetName>pricing</mktgAssetName>"
+                          "<activityAttributes>%s</activityAttributes>"
+                          "</activityRecord>" % (16095520 + i, attrs))
+    return _envelope("<ns1:successGetLeadActivity><leadActivityList>"
+                     "<returnCount>%d</returnCount><remainingCount>0</remainingCount>"
+                     "<activityRecordList>%s</activityRecordList>"
+                     "</leadActivityList></ns1:successGetLeadActivity>" % (records, "".join(activities)))
+
+
+def measure(func, min_time=0.2, repeat=5):
+    """
+    Calls func in a loop until a run takes at least min_time seconds, then repeats that run.
+    Returns the number of calls per run and the per-call time of every run.
+    """
+    number = 1
+    while True:
+        started = time.time()
+        for _ in xrange(number):
+            func()
+        elapsed = time.time() - started
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(min_time / elapsed * 1.2))
+    times = [elapsed / number]
+    for _ in xrange(repeat - 1):
+        started = time.time()
+        for _ in xrange(number):
+            func()
+        times.append((time.time() - started) / number)
+    return number, times
+
+
+# run by peak_memory() in a fresh interpreter, whose heap holds nothing but the payload when measuring.
+# ru_maxrss carries over the peak of the process that started it on Linux, VmHWM belongs to the new image.
+_PEAK_SCRIPT = """
+import resource
+import sys
+sys.path.insert(0, sys.argv[1])
+from marketo.wrapper import %s as wrapper
+
+def peak():
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+with open(sys.argv[2], "rb") as f:
+    response = f.read()
+before = peak()
+result = wrapper.unwrap(response)
+sys.stdout.write(str(peak() - before))
+"""
+
+
+def peak_memory(wrapper, response):
+    """
+    Growth of the peak resident set size in KB while a new interpreter parses the response once with
+    the unwrap() of the given wrapper module. The payload is handed over in a file, so the measured
+    interpreter never holds the garbage of building it and runs do not depend on each other.
+    """
+    with tempfile.NamedTemporaryFile(suffix=".xml") as f:
+        f.write(response)
+        f.flush()
+        output = subprocess.check_output([sys.executable, "-c", _PEAK_SCRIPT % wrapper,
+                                          os.path.dirname(os.path.abspath(__file__)), f.name])
+    return int(output)
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.getheader("content-length")))
+        body = self.server.response
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml;charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def serve(response):
+    """
+    Starts a local HTTP server answering every POST with the given response, returns the server.
+    """
+    server = _Server(("127.0.0.1", 0), _Handler)
+    server.response = response
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class _Micro:
+
+    def __init__(self):
+        self.client = Client(soap_endpoint="http://127.0.0.1/", user_id=USER_ID, encryption_key=ENCRYPTION_KEY)
+        self.lead_responses = dict((size, lead_response(size)) for size in LEAD_SIZES)
+        self.activity_responses = dict((size, activity_response(size)) for size in ACTIVITY_SIZES)
+        self.attributes = dict((size, list(_attribute_values(size))) for size in LEAD_SIZES)
+
+    def benchmarks(self):
+        client = self.client
+        yield "auth.header", lambda: auth.header(USER_ID, ENCRYPTION_KEY)
+        yield "client.wrap", lambda: client.wrap(get_lead.wrap("email", "john@doe.com"))
+        yield "get_lead.wrap", lambda: get_lead.wrap("email", "john@doe.com")
+        yield "get_lead_activity.wrap", lambda: get_lead_activity.wrap("john@doe.com")
+        for size in LEAD_SIZES:
+            attributes = self.attributes[size]
+            yield "sync_lead.wrap[%d]" % size, lambda: sync_lead.wrap(email="john@doe.com", attributes=attributes)
+        yield "exceptions.unwrap", lambda: exceptions.unwrap(FAULT)
+        for size in LEAD_SIZES:
+            response = self.lead_responses[size]
+            yield "parse.get_lead[%d]" % size, lambda: get_lead.unwrap(response)
+        for size in ACTIVITY_SIZES:
+            response = self.activity_responses[size]
+            yield "parse.get_lead_activity[%d]" % size, lambda: get_lead_activity.unwrap(response)
+
+
+def run_micro(selected, quick):
+    results = []
+    micro = _Micro()
+    for name, func in micro.benchmarks():
+        if not selected(name):
+            continue
+        number, times = measure(func, min_time=0.05 if quick else 0.2, repeat=3 if quick else 5)
+        results.append({"name": name, "kind": "time", "number": number,
+                        "mean": sum(times) / len(times), "min": min(times)})
+    return results
+
+
+def run_memory(selected):
+    results = []
+    for size in LEAD_SIZES:
+        name = "memory.get_lead[%d]" % size
+        if selected(name):
+            results.append({"name": name, "kind": "memory", "peak_kb": peak_memory("get_lead", lead_response(size))})
+    for size in ACTIVITY_SIZES:
+        name = "memory.get_lead_activity[%d]" % size
+        if selected(name):
+            results.append({"name": name, "kind": "memory",
+                            "peak_kb": peak_memory("get_lead_activity", activity_response(size))})
+    return results
+
+
+def run_end_to_end(selected, quick):
+    results = []
+    requests_per_run = 50 if quick else 400
+    for label, response, call in (("get_lead", lead_response(150), lambda c: c.get_lead(email="john@doe.com")),
+                                  ("get_lead_activity", activity_response(100),
+                                   lambda c: c.get_lead_activity(email="john@doe.com"))):
+        server = serve(response)
+        try:
+            client = Client(soap_endpoint="http://127.0.0.1:%d/" % server.server_address[1],
+                            user_id=USER_ID, encryption_key=ENCRYPTION_KEY)
+            for concurrency in CONCURRENCY:
+                name = "e2e.%s[c=%d]" % (label, concurrency)
+                if not selected(name):
+                    continue
+                pool = ThreadPool(concurrency)
+                try:
+                    started = time.time()
+                    pool.map(lambda _: call(client), xrange(requests_per_run))
+                    elapsed = time.time() - started
+                finally:
+                    pool.terminate()
+                results.append({"name": name, "kind": "throughput", "requests": requests_per_run,
+                                "seconds": elapsed, "per_second": requests_per_run / elapsed})
+        finally:
+            server.shutdown()
+            server.server_close()
+    return results
+
+
+def _format(result):
+    if result["kind"] == "time":
+        return "%12.1f us/op  (min %.1f, %d loops)" % (result["mean"] * 1e6, result["min"] * 1e6, result["number"])
+    if result["kind"] == "memory":
+        return "%12d KB peak" % result["peak_kb"]
+    return "%12.1f req/s" % result["per_second"]
+
+
+def _value(result):
+    return {"time": "mean", "memory": "peak_kb", "throughput": "per_second"}[result["kind"]]
+
+
+def report(results, baseline=None, stream=sys.stdout):
+    previous = dict((each["name"], each) for each in (baseline or {}).get("results", ()))
+    for result in results:
+        line = "%-36s %s" % (result["name"], _format(result))
+        before = previous.get(result["name"])
+        if before and before.get(_value(result)):
+            change = (result[_value(result)] - before[_value(result)]) / float(before[_value(result)]) * 100
+            line += "  %+6.1f%%" % change
+        stream.write(line + "\n")
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="marketo-python benchmarks")
+    p.add_argument("--output", help="write the results to this JSON file")
+    p.add_argument("--compare", help="JSON file of an earlier run to compare against")
+    p.add_argument("--only", help="run only the benchmarks whose name contains this string")
+    p.add_argument("--quick", action="store_true", help="fewer repeats, for a smoke test")
+    args = p.parse_args(argv)
+
+    def selected(name):
+        return not args.only or args.only in name
+
+    results = run_micro(selected, args.quick) + run_memory(selected) + run_end_to_end(selected, args.quick)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": platform.python_version(),
+                       "platform": platform.platform(),
+                       "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                       "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
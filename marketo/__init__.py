@@ -4,21 +4,73 @@ import version
 VERSION = version.VERSION
 __version__ = VERSION
 
+import datetime
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
 import requests
 import auth
+import bulk
+import campaigns
+import instrument
+import rfc3339
+import schema
+import throttle
 
+from marketo.future import Future, run
 from marketo.wrapper import exceptions
-from marketo.wrapper import get_lead, get_lead_activity, request_campaign, sync_lead
+from marketo.wrapper import describe_mobject, get_campaigns_for_source, get_lead, get_lead_activity, \
+    get_lead_changes, list_operation, request_campaign, sync_lead, sync_multiple_leads
 
 
 class Client:
 
-    def __init__(self, soap_endpoint, user_id, encryption_key):
+    def __init__(self, soap_endpoint, user_id, encryption_key, retries=0, backoff=1.0, rate_limit=None,
+                 instrumentation=None, limiter=None, session=None, schema_ttl=None,
+                 campaign_ttl=300, async_threads=8, timeout=None):
+        """
+        :param soap_endpoint: The SOAP endpoint of the Marketo instance
+        :param user_id: The SOAP API user id
+        :param encryption_key: The SOAP API encryption key
+        :param retries: How many times a request failing with a transient fault or network error is retried
+        :param backoff: Seconds to wait before the first retry, doubled on every further retry
+        :param rate_limit: Maximum number of requests per second, shared by all threads using the client
+        :param instrumentation: Receives an instrument.Event per call, see marketo.instrument
+        :param limiter: Optional throttle.AdaptiveLimiter bounding the requests in flight across threads
+        :param session: Optional requests.Session, e.g. to share its connection pool between clients
+        :param schema_ttl: Seconds the lead field schema is cached. If given, sync attributes are checked against
+            it before sending and may leave out their attrType, see marketo.schema
+        :param campaign_ttl: Seconds the campaigns looked up by name in request_campaign() are cached
+        :param async_threads: Number of threads running the syncs of sync_lead_async()
+        :param timeout: Seconds to wait for Marketo to connect or answer before requests.Timeout is raised.
+            Timeouts are retried like other network errors and cut the limit of an adaptive limiter.
+        """
         self.soap_endpoint = soap_endpoint
         self.user_id = user_id
         self.encryption_key = encryption_key
+        self.retries = retries
+        self.backoff = backoff
+        self.rate_limit = rate_limit
+        self.rate_limiter = throttle.RateLimiter(rate_limit) if rate_limit else None
+        self.instrumentation = instrumentation or instrument.NOOP
+        self.limiter = limiter
+        self.session = session
+        self.timeout = timeout
+        self.schema = schema.SchemaCache(self, schema_ttl) if schema_ttl else None
+        self.campaigns = campaigns.CampaignIndex(self, campaign_ttl)
+        self.async_threads = async_threads
+        self._executor = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
 
     def wrap(self, body):
+        event = self._event()
+        if event:
+            started = time.time()
+        header = auth.header(self.user_id, self.encryption_key)
+        if event:
+            event.add('sign', time.time() - started)
         return u'<env:Envelope xmlns:xsd="http://www.w3.org/2001/XMLSchema" ' \
                u'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" ' \
                u'xmlns:wsdl="http://www.marketo.com/mktows/" ' \
@@ -30,19 +82,140 @@ class Client:
                u'<env:Body>' \
                u'{body}' \
                u'</env:Body>' \
-               u'</env:Envelope>'.format(header=auth.header(self.user_id, self.encryption_key),
+               u'</env:Envelope>'.format(header=header,
                                          body=body)
 
+    def _event(self):
+        if not self.instrumentation.enabled:
+            return None
+        return getattr(self._local, 'event', None)
+
+    def _start(self, body):
+        """
+        Starts the instrumentation event of a call on this thread, None if the instrumentation is disabled.
+        """
+        if not self.instrumentation.enabled:
+            return None
+        event = self._local.event = instrument.Event(instrument.operation(body))
+        return event
+
+    def _emit(self, event, error=None):
+        if error is not None and event.fault is None:
+            event.fault = getattr(error, 'code', None) or type(error).__name__
+        event.finish()
+        self.instrumentation.emit(event)
+
+    def fetch(self, body):
+        """
+        Sends a request body and returns the UTF-8 encoded response of a successful call.
+        The network phases are added to the event started on this thread, which is detached when done.
+
+        :param body: The call parameters, as built by the wrap() function of a wrapper module
+        :return: The response :raise exceptions.unwrap:
+        """
+        self._local.error = None
+        try:
+            response = self.request(body)
+            event = self._event()
+            if event:
+                event.status = response.status_code
+            if response.status_code != 200:
+                # request() has parsed the fault already if it needed it for the retries or the limiter
+                raise self._local.error or exceptions.unwrap(response.text)
+            return response.text.encode("utf-8")
+        finally:
+            self._local.event = None
+            self._local.error = None
+
+    def call(self, body, parse):
+        """
+        Sends a request body and parses a successful response with the given function.
+        Every call is reported to the instrumentation of the client.
+
+        :param body: The call parameters, as built by the wrap() function of a wrapper module
+        :param parse: Function taking the UTF-8 encoded response
+        :return: The parsed response :raise exceptions.unwrap:
+        """
+        event = self._start(body)
+        if event is None:
+            return parse(self.fetch(body))
+
+        try:
+            response = self.fetch(body)
+            started = time.time()
+            result = parse(response)
+            event.add('parse', time.time() - started)
+            event.records = len(result) if isinstance(result, list) else 1
+        except Exception as e:
+            self._emit(event, e)
+            raise
+        self._emit(event)
+        return result
+
+    @property
+    def concurrency_limit(self):
+        """
+        The number of requests currently allowed in flight by the adaptive limiter, None without one.
+        """
+        return int(self.limiter.limit) if self.limiter else None
+
     def request(self, body):
+        event = self._event()
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            if self.limiter:
+                self.limiter.acquire()
+                started = time.time()
+            try:
+                response = self.post(body)
+            except throttle.RETRYABLE as e:
+                if self.limiter:
+                    self.limiter.release(None, overloaded=throttle.is_overload(e))
+                if attempt >= self.retries:
+                    raise
+            except Exception:
+                if self.limiter:
+                    self.limiter.release()
+                raise
+            else:
+                error = None
+                if response.status_code != 200 and (self.retries or self.limiter):
+                    error = self._local.error = exceptions.unwrap(response.text)
+                if self.limiter:
+                    self.limiter.release(time.time() - started, overloaded=throttle.is_overload(error))
+                if error is None or attempt >= self.retries or not throttle.is_retryable(error):
+                    return response
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+            if event:
+                event.retries = attempt
+
+    def post(self, body):
+        event = self._event()
+        if event:
+            started = time.time()
         envelope = self.wrap(body).encode("utf-8")
         data = '<?xml version="1.0" encoding="UTF-8"?>' \
                '{envelope}'.format(envelope=envelope)
-        response = requests.post(self.soap_endpoint,
-                                 data=data,
-                                 headers={'Connection': 'Keep-Alive',
-                                          'Soapaction': '',
-                                          'Content-Type': 'text/xml;charset=UTF-8',
-                                          'Accept': '*/*'})
+        if event:
+            sent = time.time()
+            event.add('envelope', sent - started)
+            event.request_bytes += len(data)
+        try:
+            response = (self.session or requests).post(self.soap_endpoint,
+                                                       data=data,
+                                                       timeout=self.timeout,
+                                                       headers={'Connection': 'Keep-Alive',
+                                                                'Soapaction': '',
+                                                                'Content-Type': 'text/xml;charset=UTF-8',
+                                                                'Accept': '*/*'})
+        finally:
+            if event:
+                event.add('network', time.time() - sent)
+        if event:
+            event.response_bytes += len(response.content)
         return response
 
     def get_lead(self, idnum=None, cookie=None, email=None, sfdcleadid=None, leadowneremail=None,
@@ -78,42 +251,200 @@ class Client:
 
         body = get_lead.wrap(*(key_types.items()[0]))
 
-        response = self.request(body)
+        return self.call(body, get_lead.unwrap)
 
-        if response.status_code == 200:
-            return get_lead.unwrap(response.text.encode("utf-8"))
-        else:
-            raise exceptions.unwrap(response.text)
+    def get_lead_activity(self, email=None, activity_types=None, exclude_types=None, since=None, attributes=None,
+                          **kwargs):
+        """
+        This function retrieves the activity history of a single lead.
+        The activity type filter and the start date are applied by Marketo, the attribute projection while parsing.
+        http://developers.marketo.com/documentation/soap/getleadactivity/
 
-    def get_lead_activity(self, email=None):
+        :param email: The email address associated with the lead
+        :param activity_types: Activity type names to include
+        :param exclude_types: Activity type names to exclude, ignored if activity_types is given
+        :param since: Only activities created after this datetime are returned
+        :param attributes: Attribute names to keep on the activities, all are kept if not given
+        :param kwargs: Any other key type of get_lead() instead of email, e.g. idnum=384563
+        :return: :raise exceptions.unwrap:
+        """
+        key_types = dict(kwargs, email=email)
+        for each in key_types.keys():
+            if not key_types[each]:
+                del key_types[each]
 
-        if not email or not isinstance(email, (str, unicode)):
-            raise ValueError('Must supply an email as a non empty string.')
+        if len(key_types) != 1:
+            raise ValueError('Must supply exactly one lead key, e.g. an email, as a non empty value.')
 
-        body = get_lead_activity.wrap(email)
-        response = self.request(body)
-        if response.status_code == 200:
-            return get_lead_activity.unwrap(response)
-        else:
-            raise Exception(response.text)
+        key_type, key_value = key_types.items()[0]
+        body = get_lead_activity.wrap(key_value, key_type=key_type,
+                                      include_types=activity_types or (),
+                                      exclude_types=exclude_types or (),
+                                      since=rfc3339.rfc3339(since) if since else None)
+        attributes = frozenset(attributes) if attributes is not None else None
+        return self.call(body, lambda response: get_lead_activity.unwrap(response, attributes=attributes))
+
+    def iter_lead_changes(self, since=None, activity_types=None, exclude_types=None, batch_size=100,
+                          watermark=None, name='lead_changes'):
+        """
+        This function yields the lead activities created since a point in time or a stream position.
+        Every batch is fetched with getLeadChanges and the newStartPosition of the batch is stored in the
+        watermark store once all of its activities have been consumed, so a restarted poller resumes
+        after the last fully processed batch.
+        http://developers.marketo.com/documentation/soap/getleadchanges/
+
+        :param since: A datetime, or a stream position dict, used when the watermark store has no position
+        :param activity_types: Activity type names to include
+        :param exclude_types: Activity type names to exclude, ignored if activity_types is given
+        :param batch_size: Number of activities per call
+        :param watermark: Optional FileWatermarkStore or SqliteWatermarkStore from marketo.watermark
+        :param name: The key of this feed in the watermark store
+        :return: Generator of LeadActivity objects with an additional lead_id :raise exceptions.unwrap:
+        """
+        position = watermark.get(name) if watermark else None
+        if position is None:
+            if isinstance(since, dict):
+                position = since
+            elif isinstance(since, (datetime.datetime, datetime.date)):
+                position = {'oldestCreatedAt': rfc3339.rfc3339(since)}
+            else:
+                raise ValueError('Must supply since as a datetime or a stream position.')
+
+        while True:
+            body = get_lead_changes.wrap(position, include_types=activity_types or (),
+                                         exclude_types=exclude_types or (), batch_size=batch_size)
+            activities, new_position, remaining = self.call(body, get_lead_changes.unwrap)
+            for activity in activities:
+                yield activity
+
+            if new_position:
+                position = new_position
+                if watermark:
+                    watermark.set(name, position)
+            if not remaining or not activities:
+                break
+
+    def get_lead_bulk(self, key_type, key_values, threads=8, processes=None):
+        """
+        This function retrieves the lead records for many keys of the same type.
+        Responses are downloaded on a pool of threads and parsed on a pool of processes.
+
+        :param key_type: The key type, e.g. 'email' or 'idnum'
+        :param key_values: Iterable of key values
+        :param threads: Number of concurrent downloads
+        :param processes: Number of parser processes (defaults to the number of CPUs)
+        :return: List of LeadRecord or the exception of a failed key in input order
+        """
+        return list(bulk.iter_leads(self, key_type, key_values, threads=threads, processes=processes))
+
+    def get_lead_activity_bulk(self, emails, threads=8, processes=None, **filters):
+        """
+        This function retrieves the activity history of many leads.
+        Responses are downloaded on a pool of threads and parsed on a pool of processes.
+
+        :param emails: Iterable of lead email addresses
+        :param threads: Number of concurrent downloads
+        :param processes: Number of parser processes (defaults to the number of CPUs)
+        :param filters: activity_types, exclude_types, since and attributes as for get_lead_activity()
+        :return: List of LeadActivity lists or the exception of a failed email in input order
+        """
+        return list(bulk.iter_lead_activities(self, emails, threads=threads, processes=processes, **filters))
+
+    def add_to_list(self, list_name, leads, key_type='idnum', threads=4):
+        """
+        This function adds many leads to a static list, up to 100 leads per call with several calls at once.
+        http://developers.marketo.com/documentation/soap/listoperation/
+
+        :param list_name: The name of the static list
+        :param leads: Iterable of lead key values
+        :param key_type: The key type of the leads, e.g. 'idnum' or 'email'
+        :param threads: Number of concurrent calls
+        :return: List of (lead, added) tuples in input order, added None for leads missing from the response,
+            a MktException for leads missing from a response answering success false and the exception of the call
+            for the leads of failed calls
+        """
+        return self._list_operation(list_operation.ADD_TO_LIST, list_name, leads, key_type, threads)
+
+    def remove_from_list(self, list_name, leads, key_type='idnum', threads=4):
+        """
+        This function removes many leads from a static list, see add_to_list().
+
+        :return: List of (lead, removed) tuples in input order, removed None for leads missing from the response,
+            errors as in add_to_list()
+        """
+        return self._list_operation(list_operation.REMOVE_FROM_LIST, list_name, leads, key_type, threads)
+
+    def is_member_of_list(self, list_name, leads, key_type='idnum', threads=4):
+        """
+        This function checks the membership of many leads in a static list, see add_to_list().
+
+        :return: List of (lead, member) tuples in input order, member None for leads missing from the response,
+            errors as in add_to_list()
+        """
+        return self._list_operation(list_operation.IS_MEMBER_OF_LIST, list_name, leads, key_type, threads)
+
+    def _list_operation(self, operation, list_name, leads, key_type, threads):
+        if not list_name or not isinstance(list_name, (str, unicode)):
+            raise ValueError('Must supply list name as a non empty string.')
+        return list(bulk.iter_list_operation(self, operation, list_name, leads, key_type=key_type, threads=threads))
+
+    def describe_lead_fields(self):
+        """
+        This function retrieves the fields of the lead record with their data types.
+        http://developers.marketo.com/documentation/soap/describemobject/
+
+        :return: List of describe_mobject.Field objects :raise exceptions.unwrap:
+        """
+        return self.call(describe_mobject.wrap('LeadRecord'), describe_mobject.unwrap)
+
+    def _synced(self, body, parse):
+        try:
+            return self.call(body, parse)
+        except exceptions.MktUnknownLeadField:
+            # the cached schema knows a field Marketo does not know any more
+            if self.schema:
+                self.schema.invalidate()
+            raise
+
+    def get_campaigns(self, source='MKTOWS', name=None, exact_name=False):
+        """
+        This function retrieves the campaigns of a source.
+        http://developers.marketo.com/documentation/soap/getcampaignsforsource/
+
+        :param source: MKTOWS for the campaigns that can be requested over the API, or SALES
+        :param name: Only campaigns whose name contains this name are returned
+        :param exact_name: Only campaigns named exactly name are returned
+        :return: List of CampaignRecord objects :raise exceptions.unwrap:
+        """
+        body = get_campaigns_for_source.wrap(source=source, name=name, exact_name=exact_name)
+
+        return self.call(body, get_campaigns_for_source.unwrap)
 
     def request_campaign(self, campaign=None, lead=None):
+        """
+        This function triggers a campaign for one or more leads.
+        The campaign can be given by id or by name, names are resolved with the cached campaign index.
+        http://developers.marketo.com/documentation/soap/requestcampaign/
 
-        if not campaign or not isinstance(campaign, (str, unicode)):
-            raise ValueError('Must supply campaign id as a non empty string.')
+        :param campaign: The campaign id or name
+        :param lead: A Marketo lead id or a list of them
+        :return: True :raise exceptions.unwrap:
+        """
+        if not campaign or not isinstance(campaign, (str, unicode, int, long)):
+            raise ValueError('Must supply campaign id or name as a non empty string.')
 
-        if not lead or not isinstance(lead, (str, unicode)):
+        if isinstance(lead, (list, tuple)):
+            if not lead or not all(each and isinstance(each, (str, unicode)) for each in lead):
+                raise ValueError('Must supply lead ids as a non empty list of non empty strings.')
+        elif not lead or not isinstance(lead, (str, unicode)):
             raise ValueError('Must supply lead id as a non empty string.')
 
-        body = request_campaign.wrap(campaign, lead)
+        body = request_campaign.wrap(self.campaigns.resolve(campaign), lead)
 
-        response = self.request(body)
-        if response.status_code == 200:
-            return True
-        else:
-            raise Exception(response.text)
+        return self.call(body, lambda response: True)
 
-    def sync_lead(self, marketo_id=None, email=None, marketo_cookie=None, foreign_id=None, attributes=None):
+    def sync_lead(self, marketo_id=None, email=None, marketo_cookie=None, foreign_id=None, attributes=None,
+                  return_lead=True):
         """
         This function will insert or update a single lead record.
                 When updating an existing lead, the lead can be identified with one of the following keys:
@@ -128,7 +459,8 @@ class Client:
         :param marketo_cookie:
         :param foreign_id:
         :param attributes:
-        :return: :raise exceptions.unwrap:
+        :param return_lead: Whether Marketo sends back the lead record. If False only the sync status is parsed.
+        :return: The LeadRecord, or a (lead id, status, error) tuple without return_lead :raise exceptions.unwrap:
         """
         if not (marketo_id or email or marketo_cookie or foreign_id):
             raise ValueError('Must supply at least one id for the lead.')
@@ -136,16 +468,74 @@ class Client:
         if not attributes:
             raise ValueError('Must supply attributes as a non empty iterable object.')
 
+        if self.schema:
+            attributes = self.schema.get().attributes(attributes)
+
         body = sync_lead.wrap(marketo_id=marketo_id,
                               email=email,
                               marketo_cookie=marketo_cookie,
                               foreign_id=foreign_id,
-                              attributes=attributes)
+                              attributes=attributes,
+                              return_lead=return_lead)
+
+        return self._synced(body, sync_lead.unwrap if return_lead else sync_lead.unwrap_status)
+
+    def sync_lead_async(self, *args, **kwargs):
+        """
+        Non-blocking sync_lead(), run on a pool of async_threads threads started on first use.
+        Pass return_lead=False when the lead record is not needed.
+
+        :return: Future of the sync_lead() result
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPool(self.async_threads)
+        future = Future()
+        self._executor.apply_async(run, (future, self.sync_lead) + args, kwargs)
+        return future
+
+    def close(self):
+        """
+        Waits for the syncs queued by sync_lead_async() and stops their threads.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor:
+            executor.close()
+            executor.join()
+
+    def sync_multiple_leads(self, leads, dedup=True):
+        """
+        This function will insert or update more lead records in one call.
+        http://developers.marketo.com/documentation/soap/syncmultipleleads/
+
+        :param leads: Iterable of dicts with the sync_lead() keyword arguments except marketo_cookie
+        :param dedup: Whether Marketo should dedupe the leads on email
+        :return: List of (lead id, status, error) tuples, one per lead :raise exceptions.unwrap:
+        """
+        leads = list(leads)
+        if not leads:
+            raise ValueError('Must supply leads as a non empty iterable object.')
 
-        response = self.request(body)
+        for lead in leads:
+            if not (lead.get('marketo_id') or lead.get('email') or lead.get('foreign_id')):
+                raise ValueError('Must supply at least one id for every lead.')
 
-        if response.status_code == 200:
-            return sync_lead.unwrap(response.text.encode("utf-8"))
+        statuses = [None] * len(leads)
+        if self.schema:
+            # leads failing the schema check are answered locally and not sent
+            lead_schema = self.schema.get()
+            checked = []
+            for i, lead in enumerate(leads):
+                try:
+                    checked.append((i, dict(lead, attributes=lead_schema.attributes(lead.get('attributes', ())))))
+                except exceptions.MktException as e:
+                    statuses[i] = (None, 'FAILED', unicode(e))
         else:
-            raise exceptions.unwrap(response.text)
+            checked = list(enumerate(leads))
 
+        if checked:
+            body = sync_multiple_leads.wrap([lead for i, lead in checked], dedup=dedup)
+            for (i, lead), status in zip(checked, self._synced(body, sync_multiple_leads.unwrap)):
+                statuses[i] = status
+        return statuses
@@ -0,0 +1,230 @@
+import collections
+import functools
+import time
+from multiprocessing.pool import Pool, ThreadPool
+
+from marketo import rfc3339
+
+from marketo.wrapper import exceptions
+from marketo.wrapper import get_lead
+from marketo.wrapper import get_lead_activity
+from marketo.wrapper import lead_activity
+from marketo.wrapper import lead_record
+from marketo.wrapper import list_operation
+
+# number of keys downloaded and parsed before results are handed back to the caller
+CHUNK_SIZE = 500
+
+# leads per listOperation call, the limit of the API
+LIST_CHUNK_SIZE = 100
+
+
+def _parse_lead(response):
+    lead = get_lead.unwrap(response)
+    return lead.id, lead.email, lead.attributes, lead.attribute_types
+
+
+def _parse_activities(response, attributes=None):
+    return [(activity.id, activity.type, activity.timestamp, activity.attributes, activity.attribute_types)
+            for activity in get_lead_activity.unwrap(response, attributes=attributes)]
+
+
+def _build_lead(compact):
+    lead = lead_record.LeadRecord()
+    lead.id, lead.email, lead.attributes, lead.attribute_types = compact
+    return lead
+
+
+def _build_activities(compact):
+    activities = []
+    for each in compact:
+        activity = lead_activity.LeadActivity()
+        activity.id, activity.type, activity.timestamp, activity.attributes, activity.attribute_types = each
+        activities.append(activity)
+    return activities
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for each in iterable:
+        chunk.append(each)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _download(client, body):
+    # the instrumentation event of the key, if any, is reported once it is parsed
+    event = client._start(body)
+    try:
+        return client.fetch(body), event
+    except Exception as e:
+        if event:
+            client._emit(event, e)
+        return e, None
+
+
+def _timed(parse, response):
+    started = time.time()
+    result = parse(response)
+    return time.time() - started, result
+
+
+def _run(client, bodies, parse, build, threads, processes, chunk_size):
+    """
+    Downloads the request bodies on a pool of I/O threads and parses the raw responses
+    on a pool of worker processes. Workers return plain tuples which are turned back into
+    wrapper objects here, so only compact data crosses the process boundary.
+    At most chunk_size keys are downloading or parsing at once, new downloads start as results are taken.
+    Results are yielded in input order; a key that fails, in the download or in the parser, yields its exception.
+    Every key is reported to the instrumentation of the client, with the parse time measured in the worker.
+    """
+    io_pool = ThreadPool(threads)
+    cpu_pool = Pool(processes)
+    bodies = iter(bodies)
+    downloads = collections.deque()
+    parsing = collections.deque()
+
+    def fill():
+        while len(downloads) + len(parsing) < chunk_size:
+            body = next(bodies, None)
+            if body is None:
+                return
+            downloads.append(io_pool.apply_async(_download, (client, body)))
+
+    try:
+        fill()
+        while downloads or parsing:
+            # hand finished downloads to the parsers, waiting for one only when nothing else is pending
+            while downloads and (downloads[0].ready() or not parsing):
+                response, event = downloads.popleft().get()
+                if isinstance(response, Exception):
+                    parsing.append((response, None))
+                else:
+                    parsing.append((cpu_pool.apply_async(_timed, (parse, response)), event))
+                fill()
+            each, event = parsing.popleft()
+            fill()
+            if isinstance(each, Exception):
+                yield each
+                continue
+            try:
+                seconds, compact = each.get()
+                result = build(compact)
+            except Exception as e:
+                if event:
+                    client._emit(event, e)
+                yield e
+                continue
+            if event:
+                event.add('parse', seconds)
+                event.records = len(result) if isinstance(result, list) else 1
+                client._emit(event)
+            yield result
+    finally:
+        io_pool.terminate()
+        cpu_pool.terminate()
+
+
+def iter_leads(client, key_type, key_values, threads=8, processes=None, chunk_size=CHUNK_SIZE):
+    """
+    Retrieves the lead records for many keys of the same type.
+
+    :param client: The marketo.Client used for the requests
+    :param key_type: The key type, e.g. 'email' or 'idnum'
+    :param key_values: Iterable of key values
+    :param threads: Number of concurrent downloads
+    :param processes: Number of parser processes (defaults to the number of CPUs)
+    :param chunk_size: Number of keys downloading or parsing at once, bounds memory use
+    :return: Generator of LeadRecord or the exception of a failed key, one per key in input order
+    """
+    bodies = (get_lead.wrap(key_type, each) for each in key_values)
+    return _run(client, bodies, _parse_lead, _build_lead, threads, processes, chunk_size)
+
+
+def iter_lead_activities(client, emails, threads=8, processes=None, chunk_size=CHUNK_SIZE,
+                         activity_types=None, exclude_types=None, since=None, attributes=None):
+    """
+    Retrieves the activity history of many leads.
+
+    :param client: The marketo.Client used for the requests
+    :param emails: Iterable of lead email addresses
+    :param threads: Number of concurrent downloads
+    :param processes: Number of parser processes (defaults to the number of CPUs)
+    :param chunk_size: Number of keys downloading or parsing at once, bounds memory use
+    :param activity_types: Activity type names to include
+    :param exclude_types: Activity type names to exclude, ignored if activity_types is given
+    :param since: Only activities created after this datetime are returned
+    :param attributes: Attribute names to keep on the activities, all are kept if not given
+    :return: Generator of LeadActivity lists or the exception of a failed email, one per email in input order
+    """
+    since = rfc3339.rfc3339(since) if since else None
+    bodies = (get_lead_activity.wrap(each, include_types=activity_types or (), exclude_types=exclude_types or (),
+                                     since=since) for each in emails)
+    parse = functools.partial(_parse_activities,
+                              attributes=frozenset(attributes) if attributes is not None else None)
+    return _run(client, bodies, parse, _build_activities, threads, processes, chunk_size)
+
+
+def iter_list_operation(client, operation, list_name, leads, key_type='idnum', threads=4,
+                        chunk_size=LIST_CHUNK_SIZE):
+    """
+    Runs a listOperation for many leads, chunk_size leads per call and up to `threads` calls at once.
+    The calls go through client.call, so the rate limit and the limiter of the client apply.
+    New calls start as results are taken, at most CHUNK_SIZE leads or `threads` calls are pending.
+
+    :param client: The marketo.Client used for the requests
+    :param operation: list_operation.ADD_TO_LIST, REMOVE_FROM_LIST or IS_MEMBER_OF_LIST
+    :param list_name: The name of the static list
+    :param leads: Iterable of lead key values
+    :param key_type: The key type of the leads, e.g. 'idnum' or 'email'
+    :param threads: Number of concurrent calls
+    :param chunk_size: Number of leads per call
+    :return: Generator of (lead, status) tuples in input order. The status is None for a lead missing from
+        the statusList of a successful call, a MktException for a lead missing from the statusList of a call
+        answering success false, and the exception of the call for the leads of a failed call
+    """
+    def key(value):
+        # Marketo may echo emails in another case
+        value = unicode(value)
+        return value.lower() if key_type.lower() == 'email' else value
+
+    def run(chunk):
+        body = list_operation.wrap(operation, list_name, chunk, key_type=key_type)
+        try:
+            return chunk, client.call(body, list_operation.unwrap)
+        except Exception as e:
+            return chunk, e
+
+    io_pool = ThreadPool(threads)
+    chunks = _chunks(leads, chunk_size)
+    window = max(threads, CHUNK_SIZE // chunk_size)
+    pending = collections.deque()
+
+    def fill():
+        while len(pending) < window:
+            chunk = next(chunks, None)
+            if chunk is None:
+                return
+            pending.append(io_pool.apply_async(run, (chunk,)))
+
+    try:
+        fill()
+        while pending:
+            chunk, result = pending.popleft().get()
+            fill()
+            if isinstance(result, Exception):
+                for lead in chunk:
+                    yield lead, result
+                continue
+            success, statuses = result
+            statuses = dict((key(value), status) for value, status in statuses.iteritems())
+            for lead in chunk:
+                status = statuses.get(key(lead))
+                if status is None and not success:
+                    status = exceptions.MktException('listOperation failed without a status for lead %s' % lead)
+                yield lead, status
+    finally:
+        io_pool.terminate()
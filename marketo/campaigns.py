@@ -0,0 +1,114 @@
+"""
+Campaign lookup by name.
+
+A CampaignIndex loads the campaigns of a source with getCampaignsForSource and keeps them by id and
+by name for `ttl` seconds, so request_campaign() can take a campaign name without a lookup call
+per request. A name missing from the index reloads it, in case the campaign was created since, but
+at most once every `min_reload` seconds, so a stream of unknown names does not turn into a stream
+of getCampaignsForSource calls. While the index is reloaded, or after a reload failed, lookups are
+served from the previous index.
+
+    client.request_campaign('Welcome Email', lead_id)
+"""
+import collections
+import threading
+import time
+
+
+class CampaignIndex:
+    """
+    :param client: The Client used to load the campaigns
+    :param ttl: Seconds the campaigns are kept before they are loaded again
+    :param source: The campaign source, MKTOWS for campaigns requestable over the API
+    :param min_reload: Seconds after a load before an unknown name loads the campaigns again
+    """
+
+    def __init__(self, client, ttl=300, source='MKTOWS', min_reload=30):
+        self.client = client
+        self.ttl = ttl
+        self.source = source
+        self.min_reload = min_reload
+        self.by_id = {}
+        self.by_name = {}
+        self.loaded = None
+        # after a failed load no other load is tried before `retry`, the error is kept for lookups without index
+        self.retry = 0
+        self.error = None
+        # held while loading. Lookups wait for it only while there is no index, a stale index is served meanwhile
+        self.lock = threading.Lock()
+
+    def _load(self):
+        by_name = collections.defaultdict(list)
+        by_id = {}
+        for campaign in self.client.get_campaigns(source=self.source):
+            by_id[campaign.id] = campaign
+            by_name[campaign.name].append(campaign)
+        self.by_id, self.by_name = by_id, dict(by_name)
+        self.loaded = time.time()
+
+    def _due(self, name=None):
+        now = time.time()
+        if now < self.retry:
+            return False
+        if self.loaded is None or now - self.loaded >= self.ttl:
+            return True
+        return name is not None and name not in self.by_name and now - self.loaded >= self.min_reload
+
+    def _refresh(self, name=None):
+        """
+        Loads the campaigns if they expired, or if the given name is unknown and min_reload seconds passed.
+        Only one thread loads, the others go on with the stale index. A failed load keeps the stale index
+        and is not tried again for min_reload seconds, it raises only when there is no index to serve.
+        """
+        if not self._due(name):
+            if self.loaded is None and self.error is not None:
+                raise self.error
+            return
+        if self.loaded is None:
+            self.lock.acquire()
+        elif not self.lock.acquire(False):
+            return
+        try:
+            if not self._due(name):
+                return
+            try:
+                self._load()
+            except Exception as e:
+                self.retry = time.time() + self.min_reload
+                self.error = e
+                if self.loaded is None:
+                    raise
+            else:
+                self.retry = 0
+                self.error = None
+        finally:
+            self.lock.release()
+
+    def campaigns(self):
+        self._refresh()
+        return self.by_id.values()
+
+    def resolve(self, campaign):
+        """
+        The id of a campaign given by id or by name. Ids are returned as they are, without a lookup.
+
+        :raise ValueError: if no campaign or more than one campaign has the name
+        """
+        if isinstance(campaign, (int, long)) or campaign.isdigit():
+            return unicode(campaign)
+        self._refresh()
+        found = self.by_name.get(campaign)
+        if found is None:
+            self._refresh(campaign)
+            found = self.by_name.get(campaign, [])
+        if not found:
+            raise ValueError('Campaign %r not found.' % campaign)
+        if len(found) > 1:
+            raise ValueError('Campaign name %r is ambiguous, ids: %s.' % (campaign, ', '.join(
+                sorted(unicode(each.id) for each in found))))
+        return unicode(found[0].id)
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded = None
+            self.retry = 0
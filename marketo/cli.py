@@ -0,0 +1,268 @@
+"""
+Command line entry point for bulk jobs.
+
+    marketo [options] get --key-type email --input leads.csv --output leads.ndjson
+    marketo [options] activity --input leads.csv --output activities.parquet --format parquet
+    marketo [options] sync --input leads.ndjson --attr-type LeadScore:integer
+    marketo [options] campaign --campaign 'Welcome Email' --input leads.csv
+
+The credentials are read from --endpoint, --user-id and --encryption-key
+or from the MARKETO_SOAP_ENDPOINT, MARKETO_USER_ID and MARKETO_ENCRYPTION_KEY environment variables.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import export
+import throttle
+from marketo import Client
+
+# input columns identifying the lead of a sync, every other column is an attribute
+_SYNC_KEYS = ('marketo_id', 'email', 'foreign_id')
+
+
+class Progress:
+    """
+    Thread safe success and error counters, printed to stderr at most once per `interval` seconds.
+    """
+
+    def __init__(self, stream=sys.stderr, interval=1.0):
+        self.stream = stream
+        self.interval = interval
+        self.ok = 0
+        self.failed = 0
+        self.started = time.time()
+        self.printed = 0
+        self.lock = threading.Lock()
+
+    def update(self, ok=0, failed=0):
+        with self.lock:
+            self.ok += ok
+            self.failed += failed
+            now = time.time()
+            if now - self.printed >= self.interval:
+                self.printed = now
+                self.show()
+
+    def result(self, result):
+        if isinstance(result, Exception):
+            self.update(failed=1)
+        else:
+            self.update(ok=1)
+
+    def show(self, end="\r"):
+        elapsed = max(time.time() - self.started, 1e-6)
+        self.stream.write("%d ok  %d failed  %.1f/s%s" % (self.ok, self.failed, (self.ok + self.failed) / elapsed, end))
+        self.stream.flush()
+
+    def done(self):
+        with self.lock:
+            self.show(end="\n")
+
+
+def read_rows(path, input_format=None):
+    """
+    Yields the rows of a CSV file with a header row or of a NDJSON file as dicts.
+    The format follows the file extension unless it is given, '-' reads NDJSON from stdin.
+    CSV rows shorter than the header leave out the missing columns, fields beyond the header are dropped.
+    """
+    if input_format is None:
+        input_format = 'csv' if path.lower().endswith('.csv') else 'ndjson'
+    f = sys.stdin if path == '-' else open(path, 'rb')
+    try:
+        if input_format == 'csv':
+            for row in csv.DictReader(f):
+                # ragged rows: DictReader gives missing columns None and puts extra fields under the None key
+                yield dict((key.decode('utf-8'), value.decode('utf-8')) for key, value in row.iteritems()
+                           if key is not None and value is not None)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def _batches(iterable, size):
+    batch = []
+    for each in iterable:
+        batch.append(each)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _column(rows, name):
+    for row in rows:
+        value = row.get(name)
+        if value:
+            yield unicode(value)
+
+
+def _sync_lead(row, attr_types):
+    lead = dict((key, row[key]) for key in _SYNC_KEYS if row.get(key))
+    lead['attributes'] = [(name, attr_types.get(name, 'string'), value)
+                          for name, value in sorted(row.iteritems())
+                          if name not in _SYNC_KEYS and value is not None and value != '']
+    return lead
+
+
+def _parse_attr_types(values):
+    attr_types = {}
+    for value in values or ():
+        name, _, typ = value.rpartition(':')
+        if not name:
+            raise argparse.ArgumentTypeError('--attr-type takes NAME:TYPE, got %r' % value)
+        attr_types[name] = typ
+    return attr_types
+
+
+def get(client, args, progress):
+    rows = read_rows(args.input, args.input_format)
+    return export.export_leads(client, args.key_type, _column(rows, args.key_column or args.key_type),
+                               args.output, format=args.format, row_group_size=args.row_group_size,
+                               checkpoint=args.checkpoint, threads=args.concurrency,
+                               processes=args.processes, progress=progress.result, errors=args.errors)
+
+
+def activity(client, args, progress):
+    rows = read_rows(args.input, args.input_format)
+    return export.export_lead_activity(client, _column(rows, args.key_column or 'email'),
+                                       args.output, format=args.format, row_group_size=args.row_group_size,
+                                       checkpoint=args.checkpoint, threads=args.concurrency,
+                                       processes=args.processes, progress=progress.result, errors=args.errors)
+
+
+def sync(client, args, progress):
+    attr_types = _parse_attr_types(args.attr_type)
+    leads = (_sync_lead(row, attr_types) for row in read_rows(args.input, args.input_format))
+    output = open(args.output, 'wb') if args.output else None
+
+    def run(batch):
+        try:
+            return batch, client.sync_multiple_leads(batch, dedup=not args.no_dedup)
+        except Exception as e:
+            return batch, e
+
+    pool = ThreadPool(args.concurrency)
+    try:
+        for batch, result in pool.imap(run, _batches(leads, args.batch_size)):
+            if isinstance(result, Exception):
+                progress.update(failed=len(batch))
+                sys.stderr.write("\nbatch failed: %s\n" % result)
+                continue
+            failed = sum(1 for lead_id, status, error in result if status == 'FAILED')
+            progress.update(ok=len(result) - failed, failed=failed)
+            if output:
+                for lead_id, status, error in result:
+                    output.write(json.dumps({'id': lead_id, 'status': status, 'error': error}) + "\n")
+    finally:
+        pool.terminate()
+        if output:
+            output.close()
+
+
+def campaign(client, args, progress):
+    leads = _column(read_rows(args.input, args.input_format), args.key_column or 'id')
+
+    def run(batch):
+        try:
+            return batch, client.request_campaign(args.campaign, batch)
+        except Exception as e:
+            return batch, e
+
+    pool = ThreadPool(args.concurrency)
+    try:
+        for batch, result in pool.imap(run, _batches(leads, args.batch_size)):
+            if isinstance(result, Exception):
+                progress.update(failed=len(batch))
+                sys.stderr.write("\nbatch failed: %s\n" % result)
+            else:
+                progress.update(ok=len(batch))
+    finally:
+        pool.terminate()
+
+
+def parser():
+    p = argparse.ArgumentParser(prog='marketo', description='Bulk operations against the Marketo SOAP API.')
+    p.add_argument('--endpoint', default=os.environ.get('MARKETO_SOAP_ENDPOINT'), help='SOAP endpoint')
+    p.add_argument('--user-id', default=os.environ.get('MARKETO_USER_ID'), help='SOAP user id')
+    p.add_argument('--encryption-key', default=os.environ.get('MARKETO_ENCRYPTION_KEY'), help='SOAP encryption key')
+    p.add_argument('--concurrency', type=int, default=8, help='concurrent requests (default 8)')
+    p.add_argument('--batch-size', type=int, default=100,
+                   help='leads per sync or campaign request (default 100)')
+    p.add_argument('--adaptive', action='store_true',
+                   help='adapt the requests in flight to latency and quota faults, up to --concurrency')
+    p.add_argument('--rate-limit', type=float, default=None, help='maximum requests per second')
+    p.add_argument('--retries', type=int, default=3, help='retries of transient faults and network errors (default 3)')
+    p.add_argument('--timeout', type=float, default=None, help='seconds to wait for a response before retrying')
+    p.add_argument('--backoff', type=float, default=1.0, help='seconds before the first retry, doubled per retry')
+
+    commands = p.add_subparsers(dest='command')
+
+    def add(name, func, help):
+        command = commands.add_parser(name, help=help)
+        command.set_defaults(func=func)
+        command.add_argument('--input', required=True, help="CSV or NDJSON input file, '-' for NDJSON on stdin")
+        command.add_argument('--input-format', choices=('csv', 'ndjson'), help='defaults to the file extension')
+        command.add_argument('--key-column', help='input column holding the lead keys')
+        return command
+
+    for name, func, help in (('get', get, 'retrieve lead records'),
+                             ('activity', activity, 'export lead activity histories')):
+        command = add(name, func, help)
+        command.add_argument('--output', required=True, help='output file')
+        command.add_argument('--format', choices=sorted(export.WRITERS), default='ndjson')
+        command.add_argument('--checkpoint', help='checkpoint file for resuming an interrupted export')
+        command.add_argument('--errors', help='NDJSON file receiving the keys skipped after an error')
+        command.add_argument('--row-group-size', type=int, default=export.ROW_GROUP_SIZE,
+                             help='records per written row group (default %d)' % export.ROW_GROUP_SIZE)
+        command.add_argument('--processes', type=int, default=None, help='parser processes (default: CPU count)')
+    commands.choices['get'].add_argument('--key-type', default='email', help='lead key type (default email)')
+
+    command = add('sync', sync, 'insert or update leads, key columns: %s' % ', '.join(_SYNC_KEYS))
+    command.add_argument('--attr-type', action='append', metavar='NAME:TYPE',
+                         help='attribute type, repeatable, attributes default to string')
+    command.add_argument('--no-dedup', action='store_true', help='disable deduplication on email')
+    command.add_argument('--output', help='NDJSON file receiving the sync status of every lead')
+
+    command = add('campaign', campaign, 'request a campaign for leads given by Marketo id')
+    command.add_argument('--campaign', required=True, help='campaign id or name')
+    return p
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    if not (args.endpoint and args.user_id and args.encryption_key):
+        sys.stderr.write("marketo: --endpoint, --user-id and --encryption-key are required\n")
+        return 2
+
+    limiter = throttle.AdaptiveLimiter(initial=min(4, args.concurrency), max_limit=args.concurrency) \
+        if args.adaptive else None
+    client = Client(soap_endpoint=args.endpoint, user_id=args.user_id, encryption_key=args.encryption_key,
+                    retries=args.retries, backoff=args.backoff, rate_limit=args.rate_limit, limiter=limiter,
+                    timeout=args.timeout)
+    progress = Progress()
+    try:
+        args.func(client, args, progress)
+    except KeyboardInterrupt:
+        progress.done()
+        return 130
+    except Exception as e:
+        progress.done()
+        sys.stderr.write("marketo: %s\n" % e)
+        return 1
+    progress.done()
+    return 1 if progress.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,489 @@
+"""
+In-process emulator of the Marketo SOAP API for load and integration tests.
+
+    with emulator.Emulator(user_id='bigcorp1', encryption_key='secret', latency=0.05, error_rate=0.01) as mkto:
+        lead_id = mkto.add_lead('john@doe.com', {'FirstName': ('string', 'John')})
+        client = marketo.Client(mkto.url, 'bigcorp1', 'secret')
+        client.get_lead(idnum=lead_id)
+
+Requests are checked against the AuthenticationHeader signature the way auth.sign() produces it,
+errors are answered with the same fault envelopes Marketo sends, so exceptions.unwrap() maps them.
+"""
+import BaseHTTPServer
+import cgi
+import collections
+import datetime
+import itertools
+import random
+import SocketServer
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+import iso8601
+
+import auth
+
+MKTOWS = "{http://www.marketo.com/mktows/}"
+
+_FAULT = u'<?xml version="1.0" encoding="UTF-8"?>' \
+         u'<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/">' \
+         u'<SOAP-ENV:Body>' \
+         u'<SOAP-ENV:Fault>' \
+         u'<faultcode>SOAP-ENV:Client</faultcode>' \
+         u'<faultstring>{code} - {summary}</faultstring>' \
+         u'<detail>' \
+         u'<ns1:serviceException xmlns:ns1="http://www.marketo.com/mktows/">' \
+         u'<name>mktServiceException</name>' \
+         u'<message>{message} ({code})</message>' \
+         u'<code>{code}</code>' \
+         u'</ns1:serviceException>' \
+         u'</detail>' \
+         u'</SOAP-ENV:Fault>' \
+         u'</SOAP-ENV:Body>' \
+         u'</SOAP-ENV:Envelope>'
+
+_SUCCESS = u'<?xml version="1.0" encoding="UTF-8"?>' \
+           u'<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/" ' \
+           u'xmlns:ns1="http://www.marketo.com/mktows/">' \
+           u'<SOAP-ENV:Body>' \
+           u'<ns1:{name}><result>{result}</result></ns1:{name}>' \
+           u'</SOAP-ENV:Body>' \
+           u'</SOAP-ENV:Envelope>'
+
+# lead key types and the lead field they are matched against
+_KEY_FIELDS = {
+    'IDNUM': 'Id',
+    'EMAIL': 'Email',
+    'COOKIE': 'Cookie',
+    'FOREIGNSYSPERSONID': 'ForeignSysPersonId',
+}
+
+
+class Fault(Exception):
+
+    def __init__(self, code, summary, message):
+        Exception.__init__(self, message)
+        self.code = code
+        self.summary = summary
+        self.message = message
+
+    def envelope(self):
+        return _FAULT.format(code=self.code, summary=cgi.escape(self.summary), message=cgi.escape(self.message))
+
+
+def _el(tag, text):
+    if text is None:
+        return u"<{0} xsi:nil=\"true\" xmlns:xsi=\"http://www.w3.org/2001/XMLSchema-instance\"/>".format(tag)
+    return u"<{0}>{1}</{0}>".format(tag, cgi.escape(unicode(text)))
+
+
+def _text(element, path):
+    found = element.find(path)
+    return found.text if found is not None else None
+
+
+class Lead:
+
+    def __init__(self, id, email=None):
+        self.id = id
+        self.email = email
+        self.cookie = None
+        self.foreign_id = None
+        self.attributes = collections.OrderedDict()
+
+    def field(self, name):
+        return {'Id': self.id, 'Email': self.email, 'Cookie': self.cookie,
+                'ForeignSysPersonId': self.foreign_id}[name]
+
+    def xml(self):
+        attributes = u"".join(u"<attribute>{0}{1}{2}</attribute>".format(_el("attrName", name),
+                                                                         _el("attrType", typ),
+                                                                         _el("attrValue", value))
+                              for name, (typ, value) in self.attributes.iteritems())
+        foreign = _el("ForeignSysPersonId", self.foreign_id) + _el("ForeignSysType", "CUSTOM") \
+            if self.foreign_id else u""
+        return u"<leadRecord>{0}{1}{2}<leadAttributeList>{3}</leadAttributeList></leadRecord>".format(
+            _el("Id", self.id), _el("Email", self.email), foreign, attributes)
+
+
+class Activity:
+
+    def __init__(self, id, type, created, attributes):
+        self.id = id
+        self.type = type
+        self.created = created
+        self.attributes = attributes
+
+    def xml(self):
+        attributes = u"".join(u"<attribute>{0}{1}{2}</attribute>".format(_el("attrName", name),
+                                                                         _el("attrType", typ),
+                                                                         _el("attrValue", value))
+                              for name, typ, value in self.attributes)
+        return u"<activityRecord>{0}{1}{2}<activityAttributes>{3}</activityAttributes></activityRecord>".format(
+            _el("id", self.id), _el("activityDateTime", self.created.strftime("%Y-%m-%dT%H:%M:%SZ")),
+            _el("activityType", self.type), attributes)
+
+
+class Emulator:
+    """
+    :param user_id: The SOAP user id accepted by the emulator
+    :param encryption_key: The key requests must be signed with
+    :param latency: Seconds added to every response, or a (min, max) tuple for a uniform random latency
+    :param error_rate: Fraction of requests answered with an internal error fault (20011)
+    :param quota: Maximum number of requests per quota_period, further requests get a limit fault (20015)
+    :param quota_period: Length of the quota window in seconds
+    :param fields: Optional dict of lead field names to attrType, syncs of other fields fail with 20105.
+        describeMObject lists them after the read-only Id and the Email field.
+    :param seed: Seed of the random generator used for the error rate and latency
+    """
+
+    def __init__(self, user_id="emulator", encryption_key="emulator", latency=0, error_rate=0.0,
+                 quota=None, quota_period=20.0, fields=None, host="127.0.0.1", port=0, seed=None):
+        self.user_id = user_id
+        self.encryption_key = encryption_key
+        self.latency = latency
+        self.error_rate = error_rate
+        self.quota = quota
+        self.quota_period = quota_period
+        self.fields = fields
+        self.address = (host, port)
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.leads = collections.OrderedDict()
+        self.activities = collections.defaultdict(list)
+        self.campaigns = {}
+        self.campaign_requests = []
+        self.lists = {}
+        self.calls = collections.Counter()
+        self.recent = collections.deque()
+        self.lead_ids = itertools.count(1)
+        self.activity_ids = itertools.count(1)
+        self.server = None
+        self.operations = {
+            'paramsGetLead': self.get_lead,
+            'paramsGetMultipleLeads': self.get_multiple_leads,
+            'paramsSyncLead': self.sync_lead,
+            'paramsSyncMultipleLeads': self.sync_multiple_leads,
+            'paramsGetLeadActivity': self.get_lead_activity,
+            'paramsRequestCampaign': self.request_campaign,
+            'paramsDescribeMObject': self.describe_mobject,
+            'paramsListOperation': self.list_operation,
+            'paramsGetCampaignsForSource': self.get_campaigns_for_source,
+        }
+
+    # backing store
+
+    def add_lead(self, email=None, attributes=None, foreign_id=None, cookie=None):
+        """
+        Adds a lead to the store and returns its id. Attributes map names to (attrType, value) tuples.
+        """
+        with self.lock:
+            lead = Lead(next(self.lead_ids), email)
+            lead.foreign_id = foreign_id
+            lead.cookie = cookie
+            lead.attributes.update(attributes or {})
+            self.leads[lead.id] = lead
+            self.add_activity(lead.id, "New Lead", [])
+            return lead.id
+
+    def add_activity(self, lead_id, activity_type, attributes, created=None):
+        """
+        Adds an activity to the history of a lead. Attributes is a list of (name, attrType, value) tuples.
+        """
+        with self.lock:
+            self.activities[lead_id].append(Activity(next(self.activity_ids), activity_type,
+                                                     created or datetime.datetime.utcnow(), attributes))
+
+    def add_campaign(self, campaign_id, name, description=None):
+        with self.lock:
+            self.campaigns[int(campaign_id)] = (name, description)
+
+    def add_list(self, name, lead_ids=()):
+        """
+        Adds a static list holding the given leads.
+        """
+        with self.lock:
+            self.lists[name] = set(lead_ids)
+
+    # server
+
+    @property
+    def url(self):
+        return "http://%s:%d/soap/mktows/2_0" % self.server.server_address
+
+    def start(self):
+        self.server = _Server(self.address, _Handler)
+        self.server.emulator = self
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def handle(self, data):
+        """
+        Answers one SOAP request, returns the HTTP status and the response envelope.
+        """
+        latency = self.latency
+        if isinstance(latency, tuple):
+            latency = self.random.uniform(*latency)
+        if latency:
+            time.sleep(latency)
+        try:
+            try:
+                root = ET.fromstring(data)
+            except ET.ParseError:
+                raise Fault(20012, "Request not understood", "Malformed XML")
+            self.authenticate(root)
+            self.throttle()
+            if self.error_rate and self.random.random() < self.error_rate:
+                raise Fault(20011, "Internal error", "Internal error")
+            params = root.find(".//{http://schemas.xmlsoap.org/soap/envelope/}Body")
+            params = params[0] if params is not None and len(params) else None
+            operation = params.tag.replace(MKTOWS, "") if params is not None else None
+            if operation not in self.operations:
+                raise Fault(20012, "Request not understood", "Unknown operation %s" % operation)
+            with self.lock:
+                self.calls[operation] += 1
+                name, result = self.operations[operation](params)
+            return 200, _SUCCESS.format(name=name, result=result)
+        except Fault as fault:
+            return 500, fault.envelope()
+
+    def authenticate(self, root):
+        header = root.find(".//" + MKTOWS + "AuthenticationHeader")
+        if header is None:
+            raise Fault(20014, "Authentication failed", "Authentication header missing")
+        user_id = _text(header, "mktowsUserId") or ""
+        timestamp = _text(header, "requestTimestamp") or ""
+        signature = _text(header, "requestSignature")
+        if user_id != self.user_id or signature != auth.sign(timestamp + user_id, self.encryption_key):
+            raise Fault(20014, "Authentication failed", "Bad signature")
+
+    def throttle(self):
+        if not self.quota:
+            return
+        with self.lock:
+            now = time.time()
+            while self.recent and self.recent[0] <= now - self.quota_period:
+                self.recent.popleft()
+            if len(self.recent) >= self.quota:
+                raise Fault(20015, "Request limit exceeded", "Request limit exceeded")
+            self.recent.append(now)
+
+    # operations
+
+    def find_lead(self, key_type, key_value):
+        key_type = (key_type or "").upper()
+        if key_type not in _KEY_FIELDS:
+            raise Fault(20102, "Lead key type not supported", "Lead key type %s not supported" % key_type)
+        field = _KEY_FIELDS[key_type]
+        for lead in self.leads.itervalues():
+            value = lead.field(field)
+            if value is not None and unicode(value).lower() == unicode(key_value).lower():
+                return lead
+        raise Fault(20103, "Lead not found", "No lead found with %s = %s" % (key_type, key_value))
+
+    def get_lead(self, params):
+        lead = self.find_lead(_text(params, "leadKey/keyType"), _text(params, "leadKey/keyValue"))
+        return "successGetLead", u"<count>1</count><leadRecordList>{0}</leadRecordList>".format(lead.xml())
+
+    def get_multiple_leads(self, params):
+        key_type = _text(params, ".//keyType")
+        values = [each.text for each in params.findall(".//keyValues/stringItem")]
+        leads = []
+        for value in values:
+            try:
+                leads.append(self.find_lead(key_type, value))
+            except Fault as fault:
+                if fault.code != 20103:
+                    raise
+        return "successGetMultipleLeads", u"<returnCount>{0}</returnCount><remainingCount>0</remainingCount>" \
+                                          u"<leadRecordList>{1}</leadRecordList>".format(
+                                              len(leads), u"".join(lead.xml() for lead in leads))
+
+    def _sync(self, record, cookie=None):
+        lead_id = _text(record, "Id")
+        email = _text(record, "Email")
+        foreign_id = _text(record, "ForeignSysPersonId")
+        attributes = [(_text(each, "attrName"), _text(each, "attrType"), _text(each, "attrValue"))
+                      for each in record.findall("leadAttributeList/attribute")]
+        if self.fields is not None:
+            for name, typ, value in attributes:
+                if name not in self.fields:
+                    raise Fault(20105, "Unknown lead field", "Field '%s' not found" % name)
+
+        lead = None
+        for key_type, value in (("IDNUM", lead_id), ("FOREIGNSYSPERSONID", foreign_id),
+                                ("EMAIL", email), ("COOKIE", cookie)):
+            if value:
+                try:
+                    lead = self.find_lead(key_type, value)
+                    break
+                except Fault as fault:
+                    if key_type == "IDNUM":
+                        raise
+        if lead is None:
+            lead_id = self.add_lead(email=email, foreign_id=foreign_id, cookie=cookie)
+            lead = self.leads[lead_id]
+            status = "CREATED"
+        else:
+            status = "UPDATED"
+            if email:
+                lead.email = email
+            if foreign_id:
+                lead.foreign_id = foreign_id
+
+        for name, typ, value in attributes:
+            previous = lead.attributes.get(name, (None, None))[1]
+            lead.attributes[name] = (typ, value)
+            if status == "UPDATED" and previous != value:
+                self.add_activity(lead.id, "Change Data Value", [("Attribute Name", "string", name),
+                                                                 ("Old Value", "string", previous),
+                                                                 ("New Value", "string", value)])
+        return lead, status
+
+    def sync_lead(self, params):
+        lead, status = self._sync(params.find("leadRecord"), cookie=_text(params, "marketoCookie"))
+        result = u"<leadId>{0}</leadId><syncStatus>{1}{2}{3}</syncStatus>".format(
+            lead.id, _el("leadId", lead.id), _el("status", status), _el("error", None))
+        if (_text(params, "returnLead") or "").lower() == "true":
+            result += lead.xml()
+        return "successSyncLead", result
+
+    def sync_multiple_leads(self, params):
+        statuses = []
+        for record in params.findall("leadRecordList/leadRecord"):
+            try:
+                lead, status = self._sync(record)
+                statuses.append((lead.id, status, None))
+            except Fault as fault:
+                statuses.append((None, "FAILED", fault.message))
+        return "successSyncMultipleLeads", u"<syncStatusList>{0}</syncStatusList>".format(
+            u"".join(u"<syncStatus>{0}{1}{2}</syncStatus>".format(_el("leadId", lead_id), _el("status", status),
+                                                                   _el("error", error))
+                     for lead_id, status, error in statuses))
+
+    def get_lead_activity(self, params):
+        lead = self.find_lead(_text(params, "leadKey/keyType"), _text(params, "leadKey/keyValue"))
+        include = [each.text for each in params.findall("activityFilter/includeTypes/activityType")]
+        exclude = [each.text for each in params.findall("activityFilter/excludeTypes/activityType")]
+        oldest = _text(params, "startPosition/oldestCreatedAt")
+        oldest = _utc(oldest) if oldest else None
+        activities = [each for each in reversed(self.activities[lead.id])
+                      if (not include or each.type in include) and each.type not in exclude
+                      and (oldest is None or each.created >= oldest)]
+        return "successGetLeadActivity", u"<leadActivityList><returnCount>{0}</returnCount>" \
+                                         u"<remainingCount>0</remainingCount>" \
+                                         u"<activityRecordList>{1}</activityRecordList>" \
+                                         u"</leadActivityList>".format(len(activities),
+                                                                       u"".join(each.xml() for each in activities))
+
+    def request_campaign(self, params):
+        campaign_id = _text(params, "campaignId")
+        if not campaign_id or not campaign_id.isdigit() or int(campaign_id) not in self.campaigns:
+            raise Fault(20109, "Campaign not found", "Campaign %s not found" % campaign_id)
+        leads = [self.find_lead(_text(each, "keyType"), _text(each, "keyValue"))
+                 for each in params.findall("leadList/leadKey")]
+        for lead in leads:
+            self.campaign_requests.append((int(campaign_id), lead.id))
+            self.add_activity(lead.id, "Request Campaign", [("Campaign ID", "integer", campaign_id)])
+        return "successRequestCampaign", u"<success>true</success>"
+
+    def get_campaigns_for_source(self, params):
+        name = _text(params, "name")
+        exact = (_text(params, "exactName") or "").lower() == "true"
+        campaigns = [(campaign_id, campaign_name, description)
+                     for campaign_id, (campaign_name, description) in sorted(self.campaigns.iteritems())
+                     if not name or (campaign_name == name if exact else name in campaign_name)]
+        return "successGetCampaignsForSource", u"<returnCount>{0}</returnCount>" \
+                                               u"<campaignRecordList>{1}</campaignRecordList>".format(
+            len(campaigns), u"".join(u"<campaignRecord>{0}{1}{2}</campaignRecord>".format(
+                _el("id", campaign_id), _el("name", campaign_name), _el("description", description))
+                for campaign_id, campaign_name, description in campaigns))
+
+    def list_operation(self, params):
+        operation = _text(params, "listOperation")
+        name = _text(params, "listKey/keyValue")
+        if name not in self.lists:
+            raise Fault(20114, "Bad parameter", "List %s not found" % name)
+        members = self.lists[name]
+        strict = (_text(params, "strict") or "").lower() == "true"
+        statuses = []
+        for each in params.findall("listMemberList/leadKey"):
+            key_type, key_value = _text(each, "keyType"), _text(each, "keyValue")
+            try:
+                lead_id = self.find_lead(key_type, key_value).id
+            except Fault:
+                if strict:
+                    raise
+                statuses.append((key_type, key_value, False))
+                continue
+            if operation == "ADDTOLIST":
+                status = lead_id not in members
+                members.add(lead_id)
+            elif operation == "REMOVEFROMLIST":
+                status = lead_id in members
+                members.discard(lead_id)
+            elif operation == "ISMEMBEROFLIST":
+                status = lead_id in members
+            else:
+                raise Fault(20114, "Bad parameter", "Unknown list operation %s" % operation)
+            statuses.append((key_type, key_value, status))
+        return "successListOperation", u"<success>true</success><statusList>{0}</statusList>".format(
+            u"".join(u"<leadStatus><leadKey>{0}{1}</leadKey>{2}</leadStatus>".format(
+                _el("keyType", key_type), _el("keyValue", key_value), _el("status", "true" if status else "false"))
+                for key_type, key_value, status in statuses))
+
+    def describe_mobject(self, params):
+        name = _text(params, "objectName")
+        if name != "LeadRecord":
+            raise Fault(20114, "Bad parameter", "Object %s can not be described" % name)
+        fields = [("Id", "integer", True), ("Email", "email", False)]
+        fields.extend((field, typ, False) for field, typ in sorted((self.fields or {}).iteritems()))
+        return "successDescribeMObject", u"<metadata>{0}{1}<fieldList>{2}</fieldList></metadata>".format(
+            _el("name", name), _el("isCustom", "false"),
+            u"".join(u"<field>{0}{1}{2}{3}{4}</field>".format(_el("name", field), _el("displayName", field),
+                                                              _el("dataType", typ),
+                                                              _el("isReadonly", "true" if readonly else "false"),
+                                                              _el("isCustom", "false"))
+                     for field, typ, readonly in fields))
+
+
+def _utc(text):
+    """
+    Parses a timestamp sent by the client into a naive UTC datetime.
+    """
+    parsed = iso8601.parse_date(text)
+    return parsed.replace(tzinfo=None) - parsed.utcoffset()
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers.getheader("content-length") or 0))
+        status, body = self.server.emulator.handle(data)
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/xml;charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
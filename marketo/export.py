@@ -0,0 +1,314 @@
+"""
+Streaming export of leads and lead activities.
+
+Records are pulled through marketo.bulk, flattened into rows and written out in row groups,
+so memory use is bounded by the row group size rather than the size of the export.
+After every row group a checkpoint with the number of completed input keys is stored,
+an interrupted export started again with the same checkpoint continues where it stopped.
+
+A key that fails for good, e.g. with a bad parameter fault or a response that does not parse, is
+passed to the progress callback, written to the optional errors file and skipped, so it can not stop
+every resumed export at the same place. Errors that may pass, network errors, quota and internal
+faults and faults without a code, and authentication failures abort the export.
+"""
+import csv
+import datetime
+import itertools
+import json
+import os
+from collections import OrderedDict
+
+import iso8601
+
+import bulk
+import throttle
+from marketo.wrapper import exceptions
+
+ROW_GROUP_SIZE = 10000
+
+# columns which are not lead attributes and their types
+_LEAD_COLUMNS = (("id", "integer"), ("email", "string"))
+_ACTIVITY_COLUMNS = (("lead", "string"), ("id", "string"), ("type", "string"), ("timestamp", "datetime"))
+
+_INTEGER_TYPES = ("integer", "score", "reference")
+_FLOAT_TYPES = ("float", "currency", "percent")
+
+
+def _text(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+
+class NDJSONWriter:
+    """
+    Writes one JSON object per line.
+    """
+
+    def __init__(self, path, append=False):
+        self.stream = open(path, "ab" if append else "wb")
+
+    def write(self, rows, types):
+        for row in rows:
+            self.stream.write(json.dumps(row, default=_text))
+            self.stream.write("\n")
+        self.stream.flush()
+
+    def close(self):
+        self.stream.close()
+
+
+class CSVWriter:
+    """
+    Writes a CSV file with a header row. The columns are the ones seen up to the first row group,
+    attributes that only show up later are left out.
+    """
+
+    def __init__(self, path, append=False):
+        self.columns = None
+        if append and os.path.exists(path):
+            with open(path, "rb") as f:
+                header = next(csv.reader(f), None)
+            if header:
+                self.columns = [each.decode("utf-8") for each in header]
+        self.stream = open(path, "ab" if append else "wb")
+        self.writer = csv.writer(self.stream)
+
+    def write(self, rows, types):
+        if self.columns is None:
+            self.columns = list(types)
+            self.writer.writerow([each.encode("utf-8") for each in self.columns])
+        for row in rows:
+            values = (_text(row.get(each)) for each in self.columns)
+            self.writer.writerow([each.encode("utf-8") if isinstance(each, unicode) else each for each in values])
+        self.stream.flush()
+
+    def close(self):
+        self.stream.close()
+
+
+class ParquetWriter:
+    """
+    Writes a Parquet file, one Parquet row group per flushed row group. Requires pyarrow.
+    The schema is inferred from the attrType of the attributes seen up to the first row group.
+    Parquet files can not be appended to, a resumed export is written to a new part file
+    named after the checkpoint position.
+    """
+
+    def __init__(self, path, append=False, position=0):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("pyarrow is required for Parquet exports: pip install pyarrow")
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.path = "%s.%d" % (path, position) if append else path
+        self.schema = None
+        self.writer = None
+
+    def _open(self, schema):
+        return self.pq.ParquetWriter(self.path, schema)
+
+    def write(self, rows, types):
+        if self.schema is None:
+            fields = [self.pa.field(name, _arrow_type(self.pa, types.get(name))) for name in types]
+            self.schema = self.pa.schema(fields)
+            self.writer = self._open(self.schema)
+        arrays = []
+        for field in self.schema:
+            values = [_convert(row.get(field.name), types.get(field.name)) for row in rows]
+            arrays.append(self.pa.array(values, type=field.type))
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class ArrowWriter(ParquetWriter):
+    """
+    Writes an Arrow IPC stream, one record batch per flushed row group. Requires pyarrow.
+    """
+
+    def _open(self, schema):
+        self.sink = self.pa.OSFile(self.path, "wb")
+        return self.pa.RecordBatchStreamWriter(self.sink, schema)
+
+    def close(self):
+        ParquetWriter.close(self)
+        if self.writer is not None:
+            self.sink.close()
+
+
+WRITERS = {
+    "ndjson": NDJSONWriter,
+    "csv": CSVWriter,
+    "parquet": ParquetWriter,
+    "arrow": ArrowWriter,
+}
+
+
+def _arrow_type(pa, attr_type):
+    if attr_type in _INTEGER_TYPES:
+        return pa.int64()
+    if attr_type in _FLOAT_TYPES:
+        return pa.float64()
+    if attr_type == "boolean":
+        return pa.bool_()
+    if attr_type == "datetime":
+        return pa.timestamp("us", tz="UTC")
+    return pa.string()
+
+
+def _convert(value, attr_type):
+    if value is None:
+        return None
+    if attr_type in _INTEGER_TYPES:
+        return int(value)
+    if attr_type in _FLOAT_TYPES:
+        return float(value)
+    if attr_type == "boolean":
+        return value in (True, 1, "1", "true", "True")
+    if attr_type == "datetime":
+        if not isinstance(value, datetime.datetime):
+            if not value:
+                return None
+            value = iso8601.parse_date(value)
+        if value.tzinfo is not None:
+            value = value.replace(tzinfo=None) - value.utcoffset()
+        return value
+    return unicode(value)
+
+
+def _lead_rows(key, lead):
+    row = {"id": lead.id, "email": lead.email}
+    row.update(lead.attributes)
+    return [(row, lead.attribute_types)]
+
+
+def _activity_rows(email, activities):
+    rows = []
+    for activity in activities:
+        row = {"lead": email, "id": activity.id, "type": activity.type, "timestamp": activity.timestamp}
+        row.update(activity.attributes)
+        rows.append((row, activity.attribute_types))
+    return rows
+
+
+def read_checkpoint(path):
+    if not path or not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        return json.load(f)["keys"]
+
+
+def write_checkpoint(path, keys):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"keys": keys}, f)
+    os.rename(tmp, path)
+
+
+def _aborts(error):
+    # errors which may not happen again when the export is resumed, or which fail every key
+    return throttle.is_retryable(error) or isinstance(error, exceptions.MktAuthenticationFailed) or \
+        (isinstance(error, exceptions.MktException) and error.code is None)
+
+
+def _export(keys, results, to_rows, base_columns, path, format, row_group_size, checkpoint, progress, errors):
+    position = read_checkpoint(checkpoint)
+    writer_class = WRITERS[format]
+    if issubclass(writer_class, ParquetWriter):
+        writer = writer_class(path, append=position > 0, position=position)
+    else:
+        writer = writer_class(path, append=position > 0)
+    # keys failed before the checkpoint stay in the errors file of a resumed export
+    errors_file = open(errors, "a" if position > 0 else "w") if errors else None
+
+    # the keys are walked twice, once to request them and once to pair them with the results
+    pending, requested = itertools.tee(itertools.islice(keys, position, None))
+    rows = []
+    types = OrderedDict(base_columns)
+    done = position
+    try:
+        for key, result in itertools.izip(pending, results(requested)):
+            done += 1
+            if progress:
+                progress(result)
+            if isinstance(result, exceptions.MktLeadNotFound):
+                continue
+            if isinstance(result, Exception):
+                if _aborts(result):
+                    raise result
+                if errors_file:
+                    errors_file.write(json.dumps({"key": key, "error": "%s: %s" % (type(result).__name__, result),
+                                                  "code": getattr(result, "code", None)}) + "\n")
+                continue
+            for row, record_types in to_rows(key, result):
+                rows.append(row)
+                for name, attr_type in record_types.iteritems():
+                    types.setdefault(name, attr_type)
+            if len(rows) >= row_group_size:
+                writer.write(rows, types)
+                rows = []
+                if checkpoint:
+                    write_checkpoint(checkpoint, done)
+        if rows:
+            writer.write(rows, types)
+        if checkpoint:
+            write_checkpoint(checkpoint, done)
+    finally:
+        writer.close()
+        if errors_file:
+            errors_file.close()
+    return done
+
+
+def export_leads(client, key_type, key_values, path, format="ndjson", row_group_size=ROW_GROUP_SIZE,
+                 checkpoint=None, threads=8, processes=None, progress=None, errors=None):
+    """
+    Streams the lead records for many keys of the same type into a file.
+
+    :param client: The marketo.Client used for the requests
+    :param key_type: The key type, e.g. 'email' or 'idnum'
+    :param key_values: Iterable of key values, it must yield the same keys in the same order when resuming
+    :param path: The output file
+    :param format: One of 'ndjson', 'csv', 'parquet' or 'arrow'
+    :param row_group_size: Number of rows buffered before they are written out
+    :param checkpoint: Optional file recording the progress of the export
+    :param threads: Number of concurrent downloads
+    :param processes: Number of parser processes (defaults to the number of CPUs)
+    :param progress: Optional callable invoked with every result, a record or an exception
+    :param errors: Optional NDJSON file receiving the key and the error of every key skipped after a failure
+    :return: The number of keys processed
+    """
+    def results(keys):
+        return bulk.iter_leads(client, key_type, keys, threads=threads, processes=processes)
+
+    return _export(iter(key_values), results, _lead_rows, _LEAD_COLUMNS, path, format, row_group_size, checkpoint,
+                   progress, errors)
+
+
+def export_lead_activity(client, emails, path, format="ndjson", row_group_size=ROW_GROUP_SIZE,
+                         checkpoint=None, threads=8, processes=None, progress=None, errors=None):
+    """
+    Streams the activity history of many leads into a file, one row per activity.
+
+    :param client: The marketo.Client used for the requests
+    :param emails: Iterable of lead email addresses, it must yield the same emails in the same order when resuming
+    :param path: The output file
+    :param format: One of 'ndjson', 'csv', 'parquet' or 'arrow'
+    :param row_group_size: Number of rows buffered before they are written out
+    :param checkpoint: Optional file recording the progress of the export
+    :param threads: Number of concurrent downloads
+    :param processes: Number of parser processes (defaults to the number of CPUs)
+    :param progress: Optional callable invoked with every result, a record or an exception
+    :param errors: Optional NDJSON file receiving the key and the error of every key skipped after a failure
+    :return: The number of emails processed
+    """
+    def results(keys):
+        return bulk.iter_lead_activities(client, keys, threads=threads, processes=processes)
+
+    return _export(iter(emails), results, _activity_rows, _ACTIVITY_COLUMNS, path, format, row_group_size, checkpoint,
+                   progress, errors)
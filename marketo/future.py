@@ -0,0 +1,66 @@
+"""
+Futures of work handed to other threads or processes, used by Client.sync_lead_async(), ClientPool
+and ShardedDispatcher.
+"""
+import sys
+import threading
+
+
+class Future:
+    """
+    The result of work running on another thread.
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Waits for the work to finish and returns its result, or raises its exception.
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError("Timed out after %s seconds" % timeout)
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError("Timed out after %s seconds" % timeout)
+        return self._exc_info[1] if self._exc_info else None
+
+
+def run(future, func, *args, **kwargs):
+    try:
+        future.set_result(func(*args, **kwargs))
+    except Exception:
+        future.set_exception(sys.exc_info())
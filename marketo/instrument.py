@@ -0,0 +1,191 @@
+"""
+Instrumentation of client calls.
+
+A Client reports every call to its instrumentation as an Event carrying the time spent per phase,
+the request and response sizes, the number of parsed records, the fault code and the retries:
+
+    envelope  building the SOAP envelope around the call parameters, including signing
+    sign      computing the AuthenticationHeader (auth.header)
+    network   sending the request and receiving the response, summed over all attempts of a retried call;
+              the backoff between attempts and waits for the rate limiter only show in the total
+    parse     unwrapping the response into wrapper objects
+
+Bulk retrieval and exports report one event per key, the parse time measured in the parser process.
+The default Instrumentation is a no-op that the client skips entirely.
+"""
+import bisect
+import collections
+import socket
+import threading
+import time
+
+# upper bounds in seconds of the histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+PHASES = ('envelope', 'sign', 'network', 'parse', 'total')
+
+
+def operation(body):
+    """
+    The SOAP operation of a request body, e.g. 'getLead' for '<ns1:paramsGetLead>...'.
+    """
+    tag = body[1:body.find(u'>')].split(u':')[-1]
+    if tag.startswith(u'params'):
+        tag = tag[len(u'params'):]
+    return tag[:1].lower() + tag[1:]
+
+
+class Event:
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.started = time.time()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.records = 0
+        self.status = None
+        self.fault = None
+        self.retries = 0
+
+    def add(self, phase, seconds):
+        self.phases[phase] += seconds
+
+    def finish(self):
+        self.phases['total'] = time.time() - self.started
+
+    def __repr__(self):
+        return "Event (%s %s)" % (self.operation, ", ".join("%s=%.4f" % (phase, self.phases[phase])
+                                                            for phase in PHASES))
+
+
+class Instrumentation:
+    """
+    No-op instrumentation. Subclasses set enabled and override emit().
+    """
+    enabled = False
+
+    def emit(self, event):
+        pass
+
+
+NOOP = Instrumentation()
+
+
+class Histogram:
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, q):
+        """
+        Upper bound of the bucket holding the q-th (0 to 1) observation.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class HistogramInstrumentation(Instrumentation):
+    """
+    Aggregates events in memory: a latency histogram per operation and phase, plus counters of calls,
+    faults per code, retries, bytes and records per operation.
+    """
+    enabled = True
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = collections.defaultdict(collections.Counter)
+
+    def emit(self, event):
+        with self.lock:
+            for phase, seconds in event.phases.iteritems():
+                key = (event.operation, phase)
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(self.buckets)
+                self.histograms[key].observe(seconds)
+            counters = self.counters[event.operation]
+            counters['calls'] += 1
+            counters['retries'] += event.retries
+            counters['request_bytes'] += event.request_bytes
+            counters['response_bytes'] += event.response_bytes
+            counters['records'] += event.records
+            if event.fault is not None:
+                counters['fault:%s' % event.fault] += 1
+
+    def histogram(self, operation, phase):
+        with self.lock:
+            return self.histograms.get((operation, phase))
+
+    def prometheus(self, prefix='marketo'):
+        """
+        The aggregated metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self.lock:
+            name = '%s_phase_seconds' % prefix
+            lines.append('# TYPE %s histogram' % name)
+            for (op, phase), histogram in sorted(self.histograms.items()):
+                labels = 'operation="%s",phase="%s"' % (op, phase)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, le, cumulative))
+                lines.append('%s_sum{%s} %r' % (name, labels, histogram.sum))
+                lines.append('%s_count{%s} %d' % (name, labels, histogram.count))
+            for counter in ('calls', 'retries', 'request_bytes', 'response_bytes', 'records'):
+                lines.append('# TYPE %s_%s_total counter' % (prefix, counter))
+                for op, counters in sorted(self.counters.items()):
+                    lines.append('%s_%s_total{operation="%s"} %d' % (prefix, counter, op, counters[counter]))
+            lines.append('# TYPE %s_faults_total counter' % prefix)
+            for op, counters in sorted(self.counters.items()):
+                for key, count in sorted(counters.items()):
+                    if key.startswith('fault:'):
+                        lines.append('%s_faults_total{operation="%s",code="%s"} %d' % (prefix, op, key[6:], count))
+        return '\n'.join(lines) + '\n'
+
+
+class StatsdInstrumentation(Instrumentation):
+    """
+    Sends every event to a statsd server over UDP: a timer per phase and counters for calls, faults,
+    retries, bytes and records, named <prefix>.<operation>.<metric>.
+    """
+    enabled = True
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='marketo'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def emit(self, event):
+        name = '%s.%s' % (self.prefix, event.operation)
+        lines = ['%s.%s:%.3f|ms' % (name, phase, seconds * 1000) for phase, seconds in event.phases.iteritems()]
+        lines.append('%s.calls:1|c' % name)
+        lines.append('%s.request_bytes:%d|c' % (name, event.request_bytes))
+        lines.append('%s.response_bytes:%d|c' % (name, event.response_bytes))
+        lines.append('%s.records:%d|c' % (name, event.records))
+        if event.retries:
+            lines.append('%s.retries:%d|c' % (name, event.retries))
+        if event.fault is not None:
+            lines.append('%s.faults.%s:1|c' % (name, event.fault))
+        try:
+            self.socket.sendto('\n'.join(lines), self.address)
+        except socket.error:
+            pass
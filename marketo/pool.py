@@ -0,0 +1,172 @@
+"""
+Shared execution for many Marketo subscriptions.
+
+A ClientPool keeps one Client per tenant on top of a single HTTP session and a single set of worker
+threads. Every tenant has its own rate limit and concurrency cap, and the workers serve the tenants
+round robin, interactive work before bulk work, so one tenant's backfill can not starve the others.
+
+    pool = ClientPool(workers=32)
+    pool.add('acme', soap_endpoint, user_id, encryption_key, rate_limit=10, max_concurrency=4)
+    lead = pool.submit('acme', 'get_lead', email='john@doe.com').result()
+    futures = [pool.submit_bulk('acme', 'sync_lead', email=email, attributes=attrs) for email in emails]
+"""
+import collections
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from marketo import Client
+from marketo.future import Future, run
+
+
+class _Tenant:
+
+    def __init__(self, client, max_concurrency):
+        self.client = client
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self.interactive = collections.deque()
+        self.bulk = collections.deque()
+
+
+class ClientPool:
+    """
+    :param workers: Number of worker threads shared by all tenants
+    :param pool_maxsize: Connections kept open per Marketo host, defaults to the number of workers
+    :param session: Optional requests.Session to use instead of a new one
+    """
+
+    def __init__(self, workers=16, pool_maxsize=None, session=None):
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=pool_maxsize or workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+        self.tenants = collections.OrderedDict()
+        self.order = collections.deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.threads = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def add(self, tenant, soap_endpoint, user_id, encryption_key, rate_limit=None, max_concurrency=4, **options):
+        """
+        Registers the credentials of a tenant and returns its Client.
+
+        :param tenant: Name of the tenant used with submit()
+        :param rate_limit: Maximum number of requests per second of this tenant
+        :param max_concurrency: Maximum number of requests of this tenant in flight at once
+        :param options: Further Client arguments, e.g. retries or instrumentation
+        """
+        client = Client(soap_endpoint, user_id, encryption_key, rate_limit=rate_limit, session=self.session,
+                        **options)
+        with self.condition:
+            if tenant in self.tenants:
+                raise ValueError('Tenant %r is already registered.' % tenant)
+            self.tenants[tenant] = _Tenant(client, max_concurrency)
+            self.order.append(tenant)
+        return client
+
+    def client(self, tenant):
+        return self.tenants[tenant].client
+
+    def submit(self, tenant, method, *args, **kwargs):
+        """
+        Queues an interactive call. Method is the name of a Client method or a function taking the client.
+
+        :return: Future of the result
+        """
+        return self._submit(tenant, False, method, args, kwargs)
+
+    def submit_bulk(self, tenant, method, *args, **kwargs):
+        """
+        Queues a bulk call, run only when no tenant has interactive work that could run instead.
+
+        :return: Future of the result
+        """
+        return self._submit(tenant, True, method, args, kwargs)
+
+    def _submit(self, tenant, bulk, method, args, kwargs):
+        future = Future()
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('The pool is closed.')
+            state = self.tenants[tenant]
+            (state.bulk if bulk else state.interactive).append((future, method, args, kwargs))
+            self.condition.notify()
+        return future
+
+    def _next(self):
+        """
+        Picks the next task, interactive work of any tenant first, the tenants served round robin.
+        A tenant over its rate limit is skipped instead of parking a worker, its token is taken here
+        and held for the worker running the task. Must be called holding the condition.
+
+        :return: The tenant, its task and None, or None, None and the seconds until a throttled tenant
+            has a token (None if no tenant has work that could run)
+        """
+        wait = None
+        for lane in ('interactive', 'bulk'):
+            for i in range(len(self.order)):
+                name = self.order[i]
+                state = self.tenants[name]
+                queue = getattr(state, lane)
+                if queue and state.in_flight < state.max_concurrency:
+                    rate_limiter = state.client.rate_limiter
+                    if rate_limiter:
+                        delay = rate_limiter.try_acquire(hold=True)
+                        if delay:
+                            wait = delay if wait is None else min(wait, delay)
+                            continue
+                    # the tenant served now goes to the back of the line
+                    del self.order[i]
+                    self.order.append(name)
+                    state.in_flight += 1
+                    return state, queue.popleft(), None
+        return None, None, wait
+
+    def _work(self):
+        while True:
+            with self.condition:
+                state, task, wait = self._next()
+                while task is None:
+                    if self.closed and wait is None:
+                        return
+                    self.condition.wait(wait)
+                    state, task, wait = self._next()
+            future, method, args, kwargs = task
+            try:
+                if callable(method):
+                    run(future, method, state.client, *args, **kwargs)
+                else:
+                    run(future, getattr(state.client, method), *args, **kwargs)
+            finally:
+                if state.client.rate_limiter:
+                    state.client.rate_limiter.drop()
+                with self.condition:
+                    state.in_flight -= 1
+                    self.condition.notify_all()
+
+    def close(self, wait=True):
+        """
+        Stops the workers once the queued work is done.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if wait:
+            for thread in self.threads:
+                thread.join()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,97 @@
+"""
+Lead field schema used to check syncs before they are sent.
+
+The schema comes from describeMObject for LeadRecord and is cached for `ttl` seconds. Sync attributes
+naming an unknown field are rejected with MktUnknownLeadField and read-only fields or values that do
+not fit the field type with MktBadParameter, the same exceptions Marketo would answer with, but
+without spending a call. Attributes may leave out their attrType, it is taken from the schema:
+
+    client = Client(soap_endpoint, user_id, encryption_key, schema_ttl=3600)
+    client.sync_lead(email='john@doe.com', attributes=[('FirstName', 'John'), ('LeadScore', 10)])
+"""
+import collections
+import threading
+import time
+
+from marketo.wrapper import exceptions
+
+# attrTypes whose values must parse as numbers
+_NUMBER_TYPES = {'integer': int, 'float': float, 'currency': float, 'score': int, 'percent': float}
+
+
+def _error(cls, code, message):
+    error = cls(message)
+    error.code = code
+    return error
+
+
+class LeadSchema:
+    """
+    :param fields: describe_mobject.Field objects of the lead fields
+    """
+
+    def __init__(self, fields):
+        self.fields = collections.OrderedDict((field.name, field) for field in fields)
+
+    def __contains__(self, name):
+        return name in self.fields
+
+    def attribute(self, name, typ, value):
+        """
+        Checks one attribute and returns it as a (name, attrType, value) tuple, attrType from the schema if None.
+        """
+        field = self.fields.get(name)
+        if field is None:
+            raise _error(exceptions.MktUnknownLeadField, 20105, "Field '%s' not found" % name)
+        if field.readonly:
+            raise _error(exceptions.MktBadParameter, 20114, "Field '%s' is read only" % name)
+        typ = typ or field.data_type
+        convert = _NUMBER_TYPES.get(field.data_type)
+        if convert and value is not None and value != '':
+            try:
+                convert(value)
+            except (TypeError, ValueError):
+                raise _error(exceptions.MktBadParameter, 20114,
+                             "Value %r of field '%s' is not a valid %s" % (value, name, field.data_type))
+        return name, typ, value
+
+    def attributes(self, attributes):
+        """
+        Checks the attributes of a sync, given as a dict of values or as (name, value)
+        or (name, attrType, value) tuples, and returns them as (name, attrType, value) tuples.
+        """
+        if isinstance(attributes, dict):
+            attributes = attributes.iteritems()
+        checked = []
+        for attribute in attributes:
+            if len(attribute) == 2:
+                name, value = attribute
+                typ = None
+            else:
+                name, typ, value = attribute
+            checked.append(self.attribute(name, typ, value))
+        return checked
+
+
+class SchemaCache:
+    """
+    Fetches the lead schema through a client and keeps it for `ttl` seconds, shared by all threads.
+    """
+
+    def __init__(self, client, ttl=3600):
+        self.client = client
+        self.ttl = ttl
+        self.schema = None
+        self.fetched = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.schema is None or time.time() - self.fetched >= self.ttl:
+                self.schema = LeadSchema(self.client.describe_lead_fields())
+                self.fetched = time.time()
+            return self.schema
+
+    def invalidate(self):
+        with self.lock:
+            self.schema = None
@@ -0,0 +1,311 @@
+"""
+Compact binary serialization of LeadRecord and LeadActivity objects.
+
+A stream starts with a header and holds frames, each a kind byte, a varint payload length and the payload.
+Attribute names, attribute types and activity types are written once into a string table frame
+and referenced by index afterwards, so they are not repeated in every record. Integers, floats
+and timestamps are stored in native binary form.
+
+    with open('leads.mkts', 'wb') as f:
+        writer = serial.Writer(f)
+        for lead in leads:
+            writer.write(lead)
+
+    with open('leads.mkts', 'rb') as f:
+        for lead in serial.Reader(f):
+            ...
+"""
+import calendar
+import datetime
+import struct
+from cStringIO import StringIO
+
+from marketo.wrapper import lead_activity
+from marketo.wrapper import lead_record
+
+MAGIC = 'MKTS\x01'
+
+_STRING = 'S'
+_LEAD = 'L'
+_ACTIVITY = 'A'
+
+_INT = struct.Struct('<q')
+_FLOAT = struct.Struct('<d')
+_TIMESTAMP = struct.Struct('<qh')
+_NAIVE = -32768
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+# FixedOffset by minutes, shared by the timestamps read
+_ZONES = {}
+
+
+class FixedOffset(datetime.tzinfo):
+
+    def __init__(self, minutes):
+        self.minutes = minutes
+        self.offset = datetime.timedelta(minutes=minutes)
+
+    def utcoffset(self, dt):
+        return self.offset
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+    def tzname(self, dt):
+        return '%+03d:%02d' % divmod(self.minutes, 60) if self.minutes >= 0 else \
+            '-%02d:%02d' % divmod(-self.minutes, 60)
+
+    def __getinitargs__(self):
+        return self.minutes,
+
+    def __repr__(self):
+        return 'FixedOffset(%d)' % self.minutes
+
+
+def _varint(n):
+    if n < 0x80:
+        return chr(n)
+    parts = []
+    while n >= 0x80:
+        parts.append(chr((n & 0x7f) | 0x80))
+        n >>= 7
+    parts.append(chr(n))
+    return ''.join(parts)
+
+
+def _read_varint(data, pos):
+    byte = ord(data[pos])
+    if byte < 0x80:
+        return byte, pos + 1
+    n = 0
+    shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _text(data):
+    # plain ASCII stays str, like ElementTree returns it
+    try:
+        data.decode('ascii')
+        return data
+    except UnicodeDecodeError:
+        return data.decode('utf-8')
+
+
+class Writer:
+    """
+    Writes records to a binary stream, the string table grows as new names show up.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.strings = {}
+        self.stream.write(MAGIC)
+
+    def _ref(self, text):
+        # the string table maps every string to its encoded index
+        ref = self.strings.get(text)
+        if ref is None:
+            ref = self.strings[text] = _varint(len(self.strings))
+            data = text.encode('utf-8') if isinstance(text, unicode) else text
+            self.stream.write(_STRING + _varint(len(data)) + data)
+        return ref
+
+    def _value(self, value, out):
+        kind = type(value)
+        if kind is str:
+            out.append('s' + _varint(len(value)))
+            out.append(value)
+        elif kind is unicode:
+            data = value.encode('utf-8')
+            out.append('u' + _varint(len(data)))
+            out.append(data)
+        elif kind is int or kind is long:
+            out.append('i' + _INT.pack(value))
+        elif value is None:
+            out.append('n')
+        elif kind is bool:
+            out.append('t' if value else 'f')
+        elif kind is float:
+            out.append('d' + _FLOAT.pack(value))
+        elif kind is datetime.datetime:
+            offset = value.utcoffset()
+            if offset is None:
+                utc, minutes = value, _NAIVE
+            else:
+                utc, minutes = value.replace(tzinfo=None) - offset, int(offset.total_seconds()) // 60
+            micros = calendar.timegm(utc.timetuple()) * 1000000 + utc.microsecond
+            out.append('T' + _TIMESTAMP.pack(micros, minutes))
+        else:
+            raise TypeError('Can not serialize %r' % (value,))
+
+    def _attributes(self, record, out):
+        types = record.attribute_types
+        out.append(_varint(len(record.attributes)))
+        strings = self.strings
+        ref = self._ref
+        value = self._value
+        append = out.append
+        for name, attr_value in record.attributes.iteritems():
+            attr_type = types.get(name, '')
+            # names and types seen before, and short str values, are the common case
+            if name in strings and attr_type in strings:
+                append(strings[name] + strings[attr_type])
+            else:
+                append(ref(name) + ref(attr_type))
+            if type(attr_value) is str and len(attr_value) < 0x80:
+                append('s' + chr(len(attr_value)) + attr_value)
+            else:
+                value(attr_value, out)
+
+    def write(self, record):
+        out = []
+        if isinstance(record, lead_record.LeadRecord):
+            kind = _LEAD
+            self._value(record.id, out)
+            self._value(record.email, out)
+        elif isinstance(record, lead_activity.LeadActivity):
+            kind = _ACTIVITY
+            self._value(record.id, out)
+            out.append(self._ref(record.type))
+            self._value(getattr(record, 'timestamp', None), out)
+            self._value(getattr(record, 'lead_id', None), out)
+        else:
+            raise TypeError('Can not serialize %r' % (record,))
+        self._attributes(record, out)
+        payload = ''.join(out)
+        self.stream.write(kind + _varint(len(payload)) + payload)
+
+
+class Reader:
+    """
+    Iterates over the records of a binary stream written by Writer.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.strings = []
+        if stream.read(len(MAGIC)) != MAGIC:
+            raise ValueError('Not a marketo record stream.')
+
+    def _frame(self):
+        kind = self.stream.read(1)
+        if not kind:
+            return None, None
+        n = 0
+        shift = 0
+        while True:
+            byte = self.stream.read(1)
+            if not byte:
+                raise ValueError('Truncated marketo record stream: frame length cut off.')
+            byte = ord(byte)
+            n |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        data = self.stream.read(n)
+        if len(data) != n:
+            raise ValueError('Truncated marketo record stream: frame of %d bytes, %d left.' % (n, len(data)))
+        return kind, data
+
+    def _value(self, data, pos):
+        kind = data[pos]
+        pos += 1
+        if kind == 's' or kind == 'u':
+            length, pos = _read_varint(data, pos)
+            value = data[pos:pos + length]
+            return (value.decode('utf-8') if kind == 'u' else value), pos + length
+        if kind == 'i':
+            return _INT.unpack_from(data, pos)[0], pos + 8
+        if kind == 'n':
+            return None, pos
+        if kind == 't' or kind == 'f':
+            return kind == 't', pos
+        if kind == 'd':
+            return _FLOAT.unpack_from(data, pos)[0], pos + 8
+        if kind == 'T':
+            micros, minutes = _TIMESTAMP.unpack_from(data, pos)
+            value = _EPOCH + datetime.timedelta(microseconds=micros)
+            if minutes != _NAIVE:
+                zone = _ZONES.get(minutes)
+                if zone is None:
+                    zone = _ZONES[minutes] = FixedOffset(minutes)
+                value = (value + zone.offset).replace(tzinfo=zone)
+            return value, pos + _TIMESTAMP.size
+        raise ValueError('Unknown value kind %r' % kind)
+
+    def _attributes(self, record, data, pos):
+        # the common cases are inlined: string table indexes and string lengths below 128 take one byte
+        strings = self.strings
+        attributes = record.attributes
+        types = record.attribute_types
+        read_value = self._value
+        unpack_int = _INT.unpack_from
+        count, pos = _read_varint(data, pos)
+        for _ in xrange(count):
+            name = ord(data[pos])
+            attr_type = ord(data[pos + 1])
+            if name < 0x80 and attr_type < 0x80:
+                pos += 2
+            else:
+                name, pos = _read_varint(data, pos)
+                attr_type, pos = _read_varint(data, pos)
+            kind = data[pos]
+            if kind == 's' and data[pos + 1] < '\x80':
+                end = pos + 2 + ord(data[pos + 1])
+                value = data[pos + 2:end]
+                pos = end
+            elif kind == 'i':
+                value = unpack_int(data, pos + 1)[0]
+                pos += 9
+            else:
+                value, pos = read_value(data, pos)
+            name = strings[name]
+            attributes[name] = value
+            types[name] = strings[attr_type]
+        return pos
+
+    def __iter__(self):
+        while True:
+            kind, data = self._frame()
+            if kind is None:
+                return
+            if kind == _STRING:
+                self.strings.append(_text(data))
+            elif kind == _LEAD:
+                lead = lead_record.LeadRecord()
+                lead.id, pos = self._value(data, 0)
+                lead.email, pos = self._value(data, pos)
+                self._attributes(lead, data, pos)
+                yield lead
+            elif kind == _ACTIVITY:
+                activity = lead_activity.LeadActivity()
+                activity.id, pos = self._value(data, 0)
+                activity_type, pos = _read_varint(data, pos)
+                activity.type = self.strings[activity_type]
+                activity.timestamp, pos = self._value(data, pos)
+                lead_id, pos = self._value(data, pos)
+                if lead_id is not None:
+                    activity.lead_id = lead_id
+                self._attributes(activity, data, pos)
+                yield activity
+            else:
+                raise ValueError('Unknown frame kind %r' % kind)
+
+
+def dumps(records):
+    stream = StringIO()
+    writer = Writer(stream)
+    for record in records:
+        writer.write(record)
+    return stream.getvalue()
+
+
+def loads(data):
+    return list(Reader(StringIO(data)))
@@ -0,0 +1,203 @@
+"""
+Parallel lead syncs that keep the order of updates to the same lead.
+
+A ShardedDispatcher hashes the key of every sync to one of a fixed number of shards and every shard
+applies its syncs one after another, so two updates of one lead never race while different leads
+are synced in parallel. Every shard has a bounded queue: submit() blocks once a shard falls behind.
+
+    with ShardedDispatcher(client, shards=8) as dispatcher:
+        for row in rows:
+            dispatcher.submit(email=row['email'], attributes=row['attributes'])
+
+Updates of one lead are only ordered when they identify it the same way, a sync by email and a
+sync by Marketo id of the same lead can land on different shards.
+
+With processes=True every worker process builds its own Client from the settings of the given one,
+including its rate limit, a fresh adaptive limiter and a copy of its instrumentation. Each process
+therefore has its own request budget: N process shards may send up to N times the rate limit, so pass
+a client with the rate limit divided by the number of shards. Events emitted in the workers stay in
+the worker processes, so only instrumentation which sends them out (e.g. statsd) sees them.
+"""
+import cPickle
+import itertools
+import multiprocessing
+import Queue
+import threading
+import zlib
+
+from marketo import Client
+from marketo import throttle
+from marketo.future import Future, run
+
+# sync_lead() keys in the order they are picked as shard key
+KEYS = ('marketo_id', 'foreign_id', 'email', 'marketo_cookie')
+
+
+def shard_key(marketo_id=None, email=None, marketo_cookie=None, foreign_id=None, **kwargs):
+    """
+    The key a sync is sharded on: the first of the lead keys given, tagged with its type.
+    """
+    values = {'marketo_id': marketo_id, 'foreign_id': foreign_id, 'email': email, 'marketo_cookie': marketo_cookie}
+    for key in KEYS:
+        if values[key]:
+            value = unicode(values[key])
+            if key == 'email':
+                value = value.lower()
+            return u'%s:%s' % (key, value)
+    raise ValueError('Must supply at least one id for the lead.')
+
+
+def shard_of(key, shards):
+    # crc32 is the same in every process, unlike hash()
+    return (zlib.crc32(key.encode('utf-8')) & 0xffffffff) % shards
+
+
+def _settings(client):
+    """
+    The arguments of a Client like the given one for a worker process.
+    """
+    limiter = client.limiter
+    if limiter is not None:
+        limiter = throttle.AdaptiveLimiter(initial=int(limiter.limit), min_limit=limiter.min_limit,
+                                           max_limit=limiter.max_limit, decrease=limiter.decrease,
+                                           latency_decrease=limiter.latency_decrease,
+                                           tolerance=limiter.tolerance, drift=limiter.drift)
+    return {'soap_endpoint': client.soap_endpoint, 'user_id': client.user_id,
+            'encryption_key': client.encryption_key, 'retries': client.retries, 'backoff': client.backoff,
+            'rate_limit': client.rate_limit, 'limiter': limiter, 'instrumentation': client.instrumentation,
+            'timeout': client.timeout, 'schema_ttl': client.schema.ttl if client.schema else None}
+
+
+def _process_worker(settings, tasks, results):
+    client = Client(**settings)
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        task_id, kwargs = task
+        try:
+            ok, value = True, client.sync_lead(**kwargs)
+        except Exception as e:
+            ok, value = False, e
+        # pickled here, a result the queue could not pickle would be dropped and its future never done
+        try:
+            data = cPickle.dumps(value, 2)
+        except Exception as e:
+            ok, data = False, cPickle.dumps(RuntimeError('Result of the sync can not be pickled: %r' % e), 2)
+        results.put((task_id, ok, data))
+
+
+class ShardedDispatcher:
+    """
+    :param client: The Client used for the syncs. Process workers build their own client from its settings.
+    :param shards: Number of shards, each served by one worker
+    :param processes: Run the shards in worker processes instead of threads
+    :param max_pending: Syncs queued per shard before submit() blocks
+    """
+
+    def __init__(self, client, shards=8, processes=False, max_pending=1000):
+        self.client = client
+        self.shards = shards
+        self.processes = processes
+        self.workers = []
+        self.futures = {}
+        self.task_ids = itertools.count()
+        self.lock = threading.Lock()
+        if processes:
+            settings = _settings(client)
+            self.queues = [multiprocessing.Queue(max_pending) for _ in range(shards)]
+            self.results = multiprocessing.Queue()
+            for queue in self.queues:
+                worker = multiprocessing.Process(target=_process_worker, args=(settings, queue, self.results))
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+            self.collector = threading.Thread(target=self._collect)
+            self.collector.daemon = True
+            self.collector.start()
+        else:
+            self.queues = [Queue.Queue(max_pending) for _ in range(shards)]
+            for queue in self.queues:
+                worker = threading.Thread(target=self._thread_worker, args=(queue,))
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
+    def _thread_worker(self, tasks):
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            future, kwargs = task
+            run(future, self.client.sync_lead, **kwargs)
+
+    def _collect(self):
+        while True:
+            result = self.results.get()
+            if result is None:
+                return
+            task_id, ok, data = result
+            try:
+                value = cPickle.loads(data)
+            except Exception as e:
+                ok, value = False, RuntimeError('Result of the sync can not be unpickled: %r' % e)
+            with self.lock:
+                future = self.futures.pop(task_id)
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception((type(value), value, None))
+
+    def submit(self, timeout=None, **kwargs):
+        """
+        Queues a sync on the shard of its lead, blocking while that shard is full.
+
+        :param timeout: Seconds to wait for room on the shard, Queue.Full is raised after that
+        :param kwargs: The sync_lead() arguments
+        :return: Future of the sync_lead() result
+        """
+        shard = shard_of(shard_key(**kwargs), self.shards)
+        future = Future()
+        if self.processes:
+            task_id = next(self.task_ids)
+            with self.lock:
+                self.futures[task_id] = future
+            try:
+                self.queues[shard].put((task_id, kwargs), timeout=timeout)
+            except Queue.Full:
+                with self.lock:
+                    del self.futures[task_id]
+                raise
+        else:
+            self.queues[shard].put((future, kwargs), timeout=timeout)
+        return future
+
+    def backlog(self):
+        """
+        The number of queued syncs per shard.
+        """
+        return [queue.qsize() for queue in self.queues]
+
+    def close(self):
+        """
+        Waits until every queued sync is done and stops the workers.
+        """
+        for queue in self.queues:
+            queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        if self.processes:
+            self.results.put(None)
+            self.collector.join()
+            # syncs of a worker process that died are never answered
+            with self.lock:
+                futures, self.futures = self.futures, {}
+            for future in futures.values():
+                error = RuntimeError('The worker process of the sync exited.')
+                future.set_exception((RuntimeError, error, None))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,156 @@
+import collections
+import threading
+import time
+
+import requests
+
+from marketo.wrapper import exceptions
+
+# faults and transport errors which are worth another attempt
+RETRYABLE = (exceptions.MktInternalError,
+             exceptions.MktRequestLimitExceeded,
+             requests.ConnectionError,
+             requests.Timeout)
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all threads using a client.
+    Allows `rate` requests per second with bursts of up to `burst` requests.
+
+    Schedulers that must not block call try_acquire(hold=True) before handing work to a thread: the
+    token is then held for that thread and its next acquire() returns at once.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+        self._local = threading.local()
+
+    def try_acquire(self, hold=False):
+        """
+        Takes a token if one is available.
+
+        :param hold: Keep the token for the next acquire() of the calling thread
+        :return: 0 if a token was taken, else the seconds until the next one is available
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+            self.tokens -= 1
+        if hold:
+            self._local.held = True
+        return 0
+
+    def acquire(self):
+        if getattr(self._local, 'held', False):
+            self._local.held = False
+            return
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def drop(self):
+        """
+        Gives back a token held by the calling thread but not used.
+        """
+        if getattr(self._local, 'held', False):
+            self._local.held = False
+            with self.lock:
+                self.tokens = min(self.burst, self.tokens + 1)
+
+
+def is_retryable(error):
+    return isinstance(error, RETRYABLE)
+
+
+# errors which mean Marketo is overloaded or the quota is used up
+OVERLOAD = (exceptions.MktRequestLimitExceeded,
+            requests.Timeout)
+
+
+def is_overload(error):
+    return isinstance(error, OVERLOAD)
+
+
+class AdaptiveLimiter:
+    """
+    Limits the number of requests in flight with an AIMD (additive increase, multiplicative decrease) rule.
+    While response times stay near the lowest seen, the limit grows by about one per `limit` successful
+    requests. It is cut by `decrease` on a timeout or quota fault and by `latency_decrease` when the
+    response time grows past `tolerance` times the baseline.
+
+    Threads call acquire() which blocks while the limit is reached. Event loop code calls try_acquire()
+    which returns False instead of blocking, and can pass a callback to be woken once a slot is free.
+    Either way every acquire is followed by a release().
+    """
+
+    def __init__(self, initial=4, min_limit=1, max_limit=64, decrease=0.5, latency_decrease=0.9,
+                 tolerance=2.0, drift=0.01):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease = decrease
+        self.latency_decrease = latency_decrease
+        self.tolerance = tolerance
+        self.drift = drift
+        self.baseline = None
+        self.in_flight = 0
+        self.waiters = collections.deque()
+        self.condition = threading.Condition()
+
+    def try_acquire(self, callback=None):
+        """
+        Takes a slot if one is free. Otherwise returns False and, if a callback is given, queues it: it is
+        called with no arguments, from the thread releasing a slot, once that slot has been taken for it.
+        An event loop would pass e.g. lambda: loop.call_soon_threadsafe(send). The caller then owns the
+        slot and must release() it.
+        """
+        with self.condition:
+            if self.in_flight >= int(self.limit) or self.waiters:
+                if callback is not None:
+                    self.waiters.append(callback)
+                return False
+            self.in_flight += 1
+            return True
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency=None, overloaded=False):
+        """
+        :param latency: Seconds the request took, None if it failed without a meaningful response time
+        :param overloaded: Whether the request failed with a timeout or quota fault
+        """
+        with self.condition:
+            self.in_flight -= 1
+            if overloaded:
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+            elif latency is not None:
+                if self.baseline is None or latency < self.baseline:
+                    self.baseline = latency
+                else:
+                    # let the baseline follow a lasting change of the response times
+                    self.baseline = min(latency, self.baseline * (1 + self.drift))
+                if latency > self.baseline * self.tolerance:
+                    self.limit = max(self.min_limit, self.limit * self.latency_decrease)
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            woken = []
+            while self.waiters and self.in_flight < int(self.limit):
+                self.in_flight += 1
+                woken.append(self.waiters.popleft())
+            self.condition.notify_all()
+        for callback in woken:
+            callback()
@@ -0,0 +1,77 @@
+"""
+Stores for stream positions, so a poller of lead changes resumes after the last position it processed.
+A position is the dict returned as newStartPosition by getLeadChanges.
+"""
+import json
+import os
+import sqlite3
+import threading
+
+
+class FileWatermarkStore:
+    """
+    Keeps the positions in a JSON file, replaced atomically on every update.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def get(self, name):
+        with self.lock:
+            return self._load().get(name)
+
+    def set(self, name, position):
+        with self.lock:
+            positions = self._load()
+            positions[name] = position
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(positions, f)
+            os.rename(tmp, self.path)
+
+
+class SqliteWatermarkStore:
+    """
+    Keeps the positions in a sqlite table, convenient when several pollers share one database file.
+    """
+
+    def __init__(self, path, table="marketo_watermarks"):
+        self.path = path
+        self.table = table
+        self.lock = threading.Lock()
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS %s (name TEXT PRIMARY KEY, position TEXT NOT NULL)"
+                                   % self.table)
+        finally:
+            connection.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, name):
+        with self.lock:
+            connection = self._connect()
+            try:
+                row = connection.execute("SELECT position FROM %s WHERE name = ?" % self.table, (name,)).fetchone()
+            finally:
+                connection.close()
+        return json.loads(row[0]) if row else None
+
+    def set(self, name, position):
+        with self.lock:
+            connection = self._connect()
+            try:
+                with connection:
+                    connection.execute("INSERT OR REPLACE INTO %s (name, position) VALUES (?, ?)" % self.table,
+                                       (name, json.dumps(position)))
+            finally:
+                connection.close()
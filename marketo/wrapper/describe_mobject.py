@@ -0,0 +1,47 @@
+import cgi
+import xml.etree.ElementTree as ET
+
+
+class Field:
+
+    def __init__(self):
+        self.name = None
+        self.display_name = None
+        self.data_type = None
+        self.size = None
+        self.readonly = False
+        self.update_blocked = False
+        self.custom = False
+
+    def __str__(self):
+        return "Field (%s - %s)" % (self.name, self.data_type)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+def _flag(field_el, tag):
+    return (field_el.findtext(tag) or '').lower() == 'true'
+
+
+def wrap(object_name='LeadRecord'):
+    return u"<ns1:paramsDescribeMObject>" \
+           u"<objectName>{object_name}</objectName>" \
+           u"</ns1:paramsDescribeMObject>".format(object_name=cgi.escape(object_name))
+
+
+def unwrap(response):
+    root = ET.fromstring(response)
+    fields = []
+    for field_el in root.findall('.//fieldList/field'):
+        field = Field()
+        field.name = field_el.findtext('name')
+        field.display_name = field_el.findtext('displayName')
+        field.data_type = field_el.findtext('dataType')
+        size = field_el.findtext('size')
+        field.size = int(size) if size else None
+        field.readonly = _flag(field_el, 'isReadonly')
+        field.update_blocked = _flag(field_el, 'isUpdateBlocked')
+        field.custom = _flag(field_el, 'isCustom')
+        fields.append(field)
+    return fields
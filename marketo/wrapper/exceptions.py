@@ -2,6 +2,11 @@ from xml.etree import ElementTree as ET
 
 
 class MktException(Exception):
+    # the Marketo error code, if the fault carried one
+    code = None
+
+
+class MktInternalError(MktException):
     pass
 
 
@@ -9,6 +14,10 @@ class MktAuthenticationFailed(MktException):
     pass
 
 
+class MktRequestLimitExceeded(MktException):
+    pass
+
+
 class MktLeadKeyTypeNotSupported(MktException):
     pass
 
@@ -26,7 +35,9 @@ class MktBadParameter(MktException):
 
 
 _ERROR_MAP = {
+    20011: MktInternalError,
     20014: MktAuthenticationFailed,
+    20015: MktRequestLimitExceeded,
     # 20016: ERROR_REQUEST_TIMESTAMP_ERROR,
 
     20102: MktLeadKeyTypeNotSupported,
@@ -46,6 +57,7 @@ def unwrap(exception_message):
             message = root.find(".//message").text
             code = int(root.find(".//code").text)
             ret_exception = _ERROR_MAP.get(code, MktException)(message)
+            ret_exception.code = code
         else:
             message = root.find(".//faultstring").text
             ret_exception = MktException(message)
@@ -0,0 +1,38 @@
+import cgi
+import xml.etree.ElementTree as ET
+
+
+class CampaignRecord:
+
+    def __init__(self):
+        self.id = None
+        self.name = None
+        self.description = None
+
+    def __str__(self):
+        return "Campaign (%s - %s)" % (self.id, self.name)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+def wrap(source='MKTOWS', name=None, exact_name=False):
+    return u"<mkt:paramsGetCampaignsForSource>" \
+           u"<source>{source}</source>" \
+           u"{name}" \
+           u"</mkt:paramsGetCampaignsForSource>".format(source=source,
+                                                        name=u"<name>{0}</name><exactName>{1}</exactName>".format(
+                                                            cgi.escape(name), "true" if exact_name else "false")
+                                                        if name else u"")
+
+
+def unwrap(response):
+    root = ET.fromstring(response)
+    campaigns = []
+    for campaign_el in root.findall('.//campaignRecordList/campaignRecord'):
+        campaign = CampaignRecord()
+        campaign.id = int(campaign_el.findtext('id'))
+        campaign.name = campaign_el.findtext('name')
+        campaign.description = campaign_el.findtext('description')
+        campaigns.append(campaign)
+    return campaigns
@@ -1,20 +1,112 @@
-import xml.etree.ElementTree as ET
+import cgi
+import xml.etree.cElementTree as cET
+
+import iso8601
+
 import lead_activity
 
+# getLeadActivity filters on activityFilter/includeTypes, getLeadChanges on activityFilter/includeAttributes
+FILTER_TAGS = (u"includeTypes", u"excludeTypes")
+
 
-def wrap(email):
+def wrap(key_value, key_type="email", include_types=(), exclude_types=(), since=None):
+    key_value = cgi.escape(unicode(key_value))
+    start_position = u"<startPosition>" \
+                     u"<oldestCreatedAt>{0}</oldestCreatedAt>" \
+                     u"</startPosition>".format(since) if since else u""
     return u"<ns1:paramsGetLeadActivity>" \
            u"<leadKey>" \
-           u"<keyType>EMAIL</keyType>" \
-           u"<keyValue>{email}</keyValue>" \
+           u"<keyType>{key_type}</keyType>" \
+           u"<keyValue>{key_value}</keyValue>" \
            u"</leadKey>" \
-           u"</ns1:paramsGetLeadActivity>".format(email=email)
+           u"{activity_filter}" \
+           u"{start_position}" \
+           u"</ns1:paramsGetLeadActivity>".format(key_type=key_type.upper(),
+                                                  key_value=key_value,
+                                                  activity_filter=lead_activity.wrap_filter(include_types,
+                                                                                            exclude_types,
+                                                                                            tags=FILTER_TAGS),
+                                                  start_position=start_position)
+
+
+class _ActivityTarget:
+    """
+    Parser target building LeadActivity objects straight from the parser events, without an element tree.
+    The text of attributes left out by the projection is not collected at all.
+    """
+
+    def __init__(self, attributes=None):
+        self.attributes = attributes
+        self.activities = []
+        self.activity = None
+        # depth below the current activityRecord
+        self.depth = 0
+        self.attribute = None
+        self.skip = False
+        self.text = []
+
+    def start(self, tag, attrib):
+        if self.activity is None:
+            if tag == 'activityRecord':
+                self.activity = lead_activity.LeadActivity()
+                self.depth = 0
+            return
+        self.depth += 1
+        if tag == 'attribute':
+            self.attribute = {}
+            self.skip = False
+        self.text = []
+
+    def data(self, data):
+        if self.activity is not None and not self.skip:
+            self.text.append(data)
+
+    def end(self, tag):
+        activity = self.activity
+        if activity is None:
+            return
+        if self.depth == 0:
+            self.activities.append(activity)
+            self.activity = None
+            return
+        self.depth -= 1
+        attribute = self.attribute
+        if attribute is not None:
+            if tag == 'attribute':
+                if not self.skip:
+                    name = attribute.get('attrName')
+                    attr_type = attribute.get('attrType')
+                    val = attribute.get('attrValue')
+                    if attr_type == 'integer':
+                        val = int(val)
+                    activity.attributes[name] = val
+                    activity.attribute_types[name] = attr_type
+                self.attribute = None
+                self.skip = False
+            elif not self.skip:
+                text = "".join(self.text) or None
+                attribute[tag] = text
+                if tag == 'attrName' and self.attributes is not None and text not in self.attributes:
+                    self.skip = True
+        elif self.depth == 0:
+            text = "".join(self.text) or None
+            if tag == 'id':
+                activity.id = text
+            elif tag == 'activityDateTime':
+                activity.timestamp = iso8601.parse_date(text)
+            elif tag == 'activityType':
+                activity.type = text
+        self.text = []
+
+    def close(self):
+        return self.activities
 
 
-def unwrap(response):
-    root = ET.fromstring(response.text)
-    activities = []
-    for activity_el in root.findall('.//activityRecord'):
-        activity = lead_activity.unwrap(activity_el)
-        activities.append(activity)
-    return activities
+def unwrap(response, attributes=None):
+    """
+    :param response: The UTF-8 encoded response
+    :param attributes: Optional set of attribute names to keep, the others are dropped while parsing
+    """
+    parser = cET.XMLParser(target=_ActivityTarget(attributes))
+    parser.feed(response)
+    return parser.close()
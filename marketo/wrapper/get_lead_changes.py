@@ -0,0 +1,46 @@
+import cgi
+import xml.etree.ElementTree as ET
+
+import lead_activity
+
+# getLeadChanges filters on activityFilter/includeAttributes, getLeadActivity on activityFilter/includeTypes
+FILTER_TAGS = (u"includeAttributes", u"excludeAttributes")
+
+# the stream position fields in the order the API expects them
+POSITION_FIELDS = ('latestCreatedAt', 'oldestCreatedAt', 'activityCreatedAt', 'offset')
+
+
+def wrap(start_position, include_types=(), exclude_types=(), batch_size=100):
+    position = u"".join(u"<{0}>{1}</{0}>".format(field, cgi.escape(unicode(start_position[field])))
+                        for field in POSITION_FIELDS if start_position.get(field))
+    return u"<mkt:paramsGetLeadChanges>" \
+           u"<startPosition>{position}</startPosition>" \
+           u"{activity_filter}" \
+           u"<batchSize>{batch_size}</batchSize>" \
+           u"</mkt:paramsGetLeadChanges>".format(position=position,
+                                                 activity_filter=lead_activity.wrap_filter(include_types,
+                                                                                           exclude_types,
+                                                                                           tags=FILTER_TAGS),
+                                                 batch_size=batch_size)
+
+
+def unwrap(response):
+    root = ET.fromstring(response)
+    activities = []
+    for change_el in root.findall('.//leadChangeRecord'):
+        activity = lead_activity.unwrap(change_el)
+        lead_id = change_el.find('mktPersonId')
+        activity.lead_id = int(lead_id.text) if lead_id is not None and lead_id.text else None
+        activities.append(activity)
+
+    position = {}
+    position_el = root.find('.//newStartPosition')
+    if position_el is not None:
+        for field in POSITION_FIELDS:
+            field_el = position_el.find(field)
+            if field_el is not None and field_el.text:
+                position[field] = field_el.text
+
+    remaining_el = root.find('.//remainingCount')
+    remaining = int(remaining_el.text) if remaining_el is not None and remaining_el.text else 0
+    return activities, position, remaining
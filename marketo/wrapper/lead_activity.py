@@ -1,3 +1,5 @@
+import cgi
+
 import iso8601
 
 
@@ -7,6 +9,7 @@ class LeadActivity:
         self.id = 'unknown'
         self.type = 'unknown'
         self.attributes = {}
+        self.attribute_types = {}
 
     def __str__(self):
         return "Activity (%s - %s)" % (self.id, self.type)
@@ -15,7 +18,27 @@ class LeadActivity:
         return self.__str__()
 
 
-def unwrap(xml):
+def wrap_filter(include_types=(), exclude_types=(), tags=(u"includeAttributes", u"excludeAttributes")):
+    """
+    :param tags: The include and exclude tags of the operation, getLeadActivity and getLeadChanges differ
+    """
+    if include_types:
+        tag, types = tags[0], include_types
+    elif exclude_types:
+        tag, types = tags[1], exclude_types
+    else:
+        return u""
+    activity_types = u"".join(u"<activityType>{0}</activityType>".format(cgi.escape(each)) for each in types)
+    return u"<activityFilter>" \
+           u"<{tag}>{activity_types}</{tag}>" \
+           u"</activityFilter>".format(tag=tag, activity_types=activity_types)
+
+
+def unwrap(xml, attributes=None):
+    """
+    :param xml: The activityRecord element
+    :param attributes: Optional set of attribute names to keep, the others are left out
+    """
     activity = LeadActivity()
     activity.id = xml.find('id').text
     activity.timestamp = iso8601.parse_date(xml.find('activityDateTime').text)
@@ -23,6 +46,8 @@ def unwrap(xml):
 
     for attribute in xml.findall('.//attribute'):
         name = attribute.find('attrName').text
+        if attributes is not None and name not in attributes:
+            continue
         attr_type = attribute.find('attrType').text
         val = attribute.find('attrValue').text
 
@@ -30,5 +55,6 @@ def unwrap(xml):
             val = int(val)
 
         activity.attributes[name] = val
+        activity.attribute_types[name] = attr_type
 
     return activity
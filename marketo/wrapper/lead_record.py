@@ -4,6 +4,7 @@ class LeadRecord:
 
     def __init__(self):
         self.attributes = {}
+        self.attribute_types = {}
 
     def __str__(self):
         return "Lead (%s - %s)" % (self.id, self.email)
@@ -26,5 +27,6 @@ def unwrap(xml):
             val = int(val)
 
         lead.attributes[name] = val
+        lead.attribute_types[name] = attr_type
 
     return lead
@@ -0,0 +1,38 @@
+import cgi
+import xml.etree.ElementTree as ET
+
+ADD_TO_LIST = 'ADDTOLIST'
+REMOVE_FROM_LIST = 'REMOVEFROMLIST'
+IS_MEMBER_OF_LIST = 'ISMEMBEROFLIST'
+
+
+def wrap(operation, list_name, leads, key_type='idnum', strict=False):
+    lead_keys = u"".join(u"<leadKey>"
+                         u"<keyType>{key_type}</keyType>"
+                         u"<keyValue>{key_value}</keyValue>"
+                         u"</leadKey>".format(key_type=key_type.upper(), key_value=cgi.escape(unicode(each)))
+                         for each in leads)
+    return u"<mkt:paramsListOperation>" \
+           u"<listOperation>{operation}</listOperation>" \
+           u"<listKey>" \
+           u"<keyType>MKTOLISTNAME</keyType>" \
+           u"<keyValue>{list_name}</keyValue>" \
+           u"</listKey>" \
+           u"<listMemberList>{lead_keys}</listMemberList>" \
+           u"<strict>{strict}</strict>" \
+           u"</mkt:paramsListOperation>".format(operation=operation,
+                                                list_name=cgi.escape(list_name),
+                                                lead_keys=lead_keys,
+                                                strict="true" if strict else "false")
+
+
+def unwrap(response):
+    """
+    :return: The success flag of the call and a dict of lead key value to status
+    """
+    root = ET.fromstring(response)
+    success = (root.findtext('.//success') or '').lower() == 'true'
+    statuses = {}
+    for status_el in root.findall('.//statusList/leadStatus'):
+        statuses[status_el.findtext('leadKey/keyValue')] = (status_el.findtext('status') or '').lower() == 'true'
+    return success, statuses
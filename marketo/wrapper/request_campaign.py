@@ -1,12 +1,14 @@
 
 def wrap(campaign, lead):
+    leads = lead if isinstance(lead, (list, tuple)) else [lead]
+    lead_keys = u"".join(u'<leadKey>'
+                         u'<keyType>IDNUM</keyType>'
+                         u'<keyValue>{lead}</keyValue>'
+                         u'</leadKey>'.format(lead=each) for each in leads)
     return u'<mkt:paramsRequestCampaign>' \
            u'<source>MKTOWS</source>' \
            u'<campaignId>{campaign}</campaignId>' \
            u'<leadList>' \
-           u'<leadKey>' \
-           u'<keyType>IDNUM</keyType>' \
-           u'<keyValue>{lead}</keyValue>' \
-           u'</leadKey>' \
+           u'{lead_keys}' \
            u'</leadList>' \
-           u'</mkt:paramsRequestCampaign>'.format(campaign=campaign, lead=lead)
+           u'</mkt:paramsRequestCampaign>'.format(campaign=campaign, lead_keys=lead_keys)
@@ -4,7 +4,7 @@ import xml.etree.ElementTree as ET
 import lead_record
 
 
-def wrap(marketo_id=None, email=None, marketo_cookie=None, foreign_id=None, attributes=()):
+def wrap_record(marketo_id=None, email=None, foreign_id=None, attributes=()):
     tmpl = u"<attribute>" \
            u"<attrName>{name}</attrName>" \
            u"<attrType>{typ}</attrType>" \
@@ -12,20 +12,28 @@ def wrap(marketo_id=None, email=None, marketo_cookie=None, foreign_id=None, attr
            u"</attribute>"
     attr = "".join(tmpl.format(name=name, typ=typ, value=value) for name, typ, value in attributes)
 
-    return u"<mkt:paramsSyncLead>" \
-           u"<leadRecord>" \
+    return u"<leadRecord>" \
            u"{marketo_id}" \
            u"{email}" \
            u"{foreign_id}" \
            u"<leadAttributeList>{attributes}</leadAttributeList>" \
-           u"</leadRecord>" \
-           u"<returnLead>true</returnLead>" \
+           u"</leadRecord>".format(marketo_id="<Id>{0}</Id>".format(marketo_id) if marketo_id else "",
+                                   email="<Email>{0}</Email>".format(email) if email else "",
+                                   foreign_id="<ForeignSysPersonId>{0}</ForeignSysPersonId>"
+                                              "<ForeignSysType>CUSTOM</ForeignSysType>".format(foreign_id) if foreign_id else "",
+                                   attributes=attr)
+
+
+def wrap(marketo_id=None, email=None, marketo_cookie=None, foreign_id=None, attributes=(), return_lead=True):
+    return u"<mkt:paramsSyncLead>" \
+           u"{lead_record}" \
+           u"<returnLead>{return_lead}</returnLead>" \
            u"{marketo_cookie}" \
-           u"</mkt:paramsSyncLead>".format(marketo_id="<Id>{0}</Id>".format(marketo_id) if marketo_id else "",
-                                           email="<Email>{0}</Email>".format(email) if email else "",
-                                           foreign_id="<ForeignSysPersonId>{0}</ForeignSysPersonId>"
-                                                      "<ForeignSysType>CUSTOM</ForeignSysType>".format(foreign_id) if foreign_id else "",
-                                           attributes=attr,
+           u"</mkt:paramsSyncLead>".format(lead_record=wrap_record(marketo_id=marketo_id,
+                                                                   email=email,
+                                                                   foreign_id=foreign_id,
+                                                                   attributes=attributes),
+                                           return_lead="true" if return_lead else "false",
                                            marketo_cookie="<marketoCookie>{0}</marketoCookie>".format(cgi.escape(marketo_cookie)) if marketo_cookie else "")
 
 
@@ -33,3 +41,15 @@ def unwrap(response):
     root = ET.fromstring(response)
     lead_record_xml = root.find('.//leadRecord')
     return lead_record.unwrap(lead_record_xml)
+
+
+def unwrap_status(response):
+    """
+    Parses only the sync status of a response sent without the lead record.
+
+    :return: The (lead id, status, error) tuple of the lead
+    """
+    root = ET.fromstring(response)
+    status = root.find('.//syncStatus')
+    lead_id = status.findtext('leadId') or root.findtext('.//leadId')
+    return int(lead_id) if lead_id else None, status.findtext('status'), status.findtext('error') or None
@@ -0,0 +1,26 @@
+import xml.etree.ElementTree as ET
+
+import sync_lead
+
+
+def wrap(leads, dedup=True):
+    records = u"".join(sync_lead.wrap_record(marketo_id=lead.get('marketo_id'),
+                                             email=lead.get('email'),
+                                             foreign_id=lead.get('foreign_id'),
+                                             attributes=lead.get('attributes', ())) for lead in leads)
+    return u"<mkt:paramsSyncMultipleLeads>" \
+           u"<leadRecordList>{records}</leadRecordList>" \
+           u"<dedupEnabled>{dedup}</dedupEnabled>" \
+           u"</mkt:paramsSyncMultipleLeads>".format(records=records, dedup="true" if dedup else "false")
+
+
+def unwrap(response):
+    root = ET.fromstring(response)
+    statuses = []
+    for status in root.findall('.//syncStatus'):
+        lead_id = status.find('leadId').text
+        error = status.find('error')
+        statuses.append((int(lead_id) if lead_id else None,
+                         status.find('status').text,
+                         error.text if error is not None else None))
+    return statuses
@@ -25,6 +25,9 @@ setup(
     maintainer='Segment.io',
     maintainer_email='friends@segment.io',
     packages=['marketo', 'marketo.wrapper'],
+    entry_points={
+        'console_scripts': ['marketo = marketo.cli:main']
+    },
     license='MIT License',
     install_requires=[
         'requests',
@@ -1,15 +1,46 @@
 # -*- coding: utf-8 -*-
+import cStringIO
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
 
+import requests
 from mock import patch, Mock
 
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
 from marketo import auth
+from marketo import bulk
+from marketo import cli
 from marketo import Client
+from marketo import emulator
+from marketo import export
+from marketo import future
+from marketo import instrument
+from marketo import pool
+from marketo import schema
+from marketo import serial
+from marketo import shard
+from marketo import throttle
+from marketo import watermark
+from marketo.wrapper import describe_mobject
 from marketo.wrapper import exceptions
+from marketo.wrapper import get_campaigns_for_source
 from marketo.wrapper import get_lead
 from marketo.wrapper import get_lead_activity
+from marketo.wrapper import get_lead_changes
+from marketo.wrapper import list_operation
 from marketo.wrapper import request_campaign
 from marketo.wrapper import sync_lead
+from marketo.wrapper import sync_multiple_leads
 
 
 class TestAuth(unittest.TestCase):
@@ -140,6 +171,405 @@ class TestGetLeadActivity(unittest.TestCase):
                          u"</leadKey>"
                          u"</ns1:paramsGetLeadActivity>")
 
+    def test_get_lead_activity_unwrap(self):
+        response = "<root>" \
+                   "<activityRecordList>" \
+                   "<activityRecord>" \
+                   "<id>16095520</id>" \
+                   "<activityDateTime>2013-01-08T12:31:43-06:00</activityDateTime>" \
+                   "<activityType>Visit Webpage</activityType>" \
+                   "<activityAttributes>" \
+                   "<attribute>" \
+                   "<attrName>Webpage ID</attrName>" \
+                   "<attrType>integer</attrType>" \
+                   "<attrValue>22</attrValue>" \
+                   "</attribute>" \
+                   "</activityAttributes>" \
+                   "</activityRecord>" \
+                   "</activityRecordList>" \
+                   "</root>"
+        activities = get_lead_activity.unwrap(response)
+        self.assertEqual(len(activities), 1)
+        self.assertEqual(activities[0].id, "16095520")
+        self.assertEqual(activities[0].type, "Visit Webpage")
+        self.assertEqual(activities[0].timestamp.isoformat(), "2013-01-08T12:31:43-06:00")
+        self.assertEqual(activities[0].attributes, {"Webpage ID": 22})
+
+        activities = get_lead_activity.unwrap(response, attributes=frozenset(["Webpage URL"]))
+        self.assertEqual(activities[0].attributes, {})
+
+    def test_get_lead_activity_unwrap_nested(self):
+        activities = get_lead_activity.unwrap("<root><activityRecordList>"
+                                              "<activityRecord>"
+                                              "<id>1</id>"
+                                              "<activityDateTime>2013-01-08T12:31:43Z</activityDateTime>"
+                                              "<activityType>Request Campaign</activityType>"
+                                              "<campaign><id>1190</id><name>Welcome</name></campaign>"
+                                              "<activityAttributes/>"
+                                              "</activityRecord>"
+                                              "<activityRecord>"
+                                              "<id>2</id>"
+                                              "<activityDateTime>2013-01-09T12:31:43Z</activityDateTime>"
+                                              "<activityType>New Lead</activityType>"
+                                              "</activityRecord>"
+                                              "</activityRecordList></root>")
+        self.assertEqual([(each.id, each.type, each.attributes) for each in activities],
+                         [("1", "Request Campaign", {}), ("2", "New Lead", {})])
+
+    def test_get_lead_activity_wrap_with_filters(self):
+        self.assertEqual(get_lead_activity.wrap("384563", key_type="idnum", exclude_types=("Visit Webpage",),
+                                                since="2013-01-08T12:31:43Z"),
+                         u"<ns1:paramsGetLeadActivity>"
+                         u"<leadKey>"
+                         u"<keyType>IDNUM</keyType>"
+                         u"<keyValue>384563</keyValue>"
+                         u"</leadKey>"
+                         u"<activityFilter>"
+                         u"<excludeTypes>"
+                         u"<activityType>Visit Webpage</activityType>"
+                         u"</excludeTypes>"
+                         u"</activityFilter>"
+                         u"<startPosition>"
+                         u"<oldestCreatedAt>2013-01-08T12:31:43Z</oldestCreatedAt>"
+                         u"</startPosition>"
+                         u"</ns1:paramsGetLeadActivity>")
+
+
+class TestGetLeadChanges(unittest.TestCase):
+
+    def change_response(self, activity_id, offset, remaining):
+        return "<root>" \
+               "<result>" \
+               "<returnCount>1</returnCount>" \
+               "<remainingCount>%d</remainingCount>" \
+               "<newStartPosition>" \
+               "<latestCreatedAt/>" \
+               "<oldestCreatedAt>2013-01-08T12:31:43Z</oldestCreatedAt>" \
+               "<offset>%s</offset>" \
+               "</newStartPosition>" \
+               "<leadChangeRecordList>" \
+               "<leadChangeRecord>" \
+               "<id>%s</id>" \
+               "<activityDateTime>2013-01-08T12:31:43Z</activityDateTime>" \
+               "<activityType>Change Data Value</activityType>" \
+               "<activityAttributes/>" \
+               "<mktPersonId>87</mktPersonId>" \
+               "</leadChangeRecord>" \
+               "</leadChangeRecordList>" \
+               "</result>" \
+               "</root>" % (remaining, offset, activity_id)
+
+    def test_get_lead_changes_wrap(self):
+        self.assertEqual(get_lead_changes.wrap({"oldestCreatedAt": "2013-01-08T12:31:43Z"},
+                                               include_types=("Change Data Value", "New Lead"), batch_size=10),
+                         u"<mkt:paramsGetLeadChanges>"
+                         u"<startPosition>"
+                         u"<oldestCreatedAt>2013-01-08T12:31:43Z</oldestCreatedAt>"
+                         u"</startPosition>"
+                         u"<activityFilter>"
+                         u"<includeAttributes>"
+                         u"<activityType>Change Data Value</activityType>"
+                         u"<activityType>New Lead</activityType>"
+                         u"</includeAttributes>"
+                         u"</activityFilter>"
+                         u"<batchSize>10</batchSize>"
+                         u"</mkt:paramsGetLeadChanges>")
+
+    def test_get_lead_changes_unwrap(self):
+        activities, position, remaining = get_lead_changes.unwrap(self.change_response("1", "abc", 5))
+        self.assertEqual([(each.id, each.type, each.lead_id) for each in activities], [("1", "Change Data Value", 87)])
+        self.assertEqual(position, {"oldestCreatedAt": "2013-01-08T12:31:43Z", "offset": "abc"})
+        self.assertEqual(remaining, 5)
+
+    def check_watermark(self, store):
+        client = Client(soap_endpoint="_soap_endpoint_", user_id="_user_id_", encryption_key="_encryption_key_")
+        responses = [Mock(status_code=200, text=self.change_response("1", "first", 1)),
+                     Mock(status_code=200, text=self.change_response("2", "second", 0))]
+        with patch.object(client, "request", side_effect=responses) as request:
+            activities = list(client.iter_lead_changes(since={"offset": "start"}, watermark=store))
+        self.assertEqual([each.id for each in activities], ["1", "2"])
+        self.assertTrue("<offset>start</offset>" in request.call_args_list[0][0][0])
+        self.assertTrue("<offset>first</offset>" in request.call_args_list[1][0][0])
+        self.assertEqual(store.get("lead_changes"), {"oldestCreatedAt": "2013-01-08T12:31:43Z", "offset": "second"})
+
+        # the stored position wins over since
+        with patch.object(client, "request", return_value=responses[1]) as request:
+            list(client.iter_lead_changes(since={"offset": "start"}, watermark=store))
+        self.assertTrue("<offset>second</offset>" in request.call_args[0][0])
+
+    def test_iter_lead_changes_file_watermark(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.check_watermark(watermark.FileWatermarkStore(os.path.join(directory, "watermarks.json")))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_iter_lead_changes_sqlite_watermark(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.check_watermark(watermark.SqliteWatermarkStore(os.path.join(directory, "watermarks.db")))
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestBulk(unittest.TestCase):
+
+    def test_iter_leads(self):
+        client = Client(soap_endpoint="_soap_endpoint_", user_id="_user_id_", encryption_key="_encryption_key_")
+
+        def request(body):
+            if "missing" in body:
+                return Mock(status_code=500, text="<root>"
+                                                  "<detail>"
+                                                  "<message>No lead found with EMAIL = missing (20103)</message>"
+                                                  "<code>20103</code>"
+                                                  "</detail>"
+                                                  "</root>")
+            return Mock(status_code=200, text="<root>"
+                                              "<leadRecord>"
+                                              "<Id>100</Id>"
+                                              "<Email>john@doe</Email>"
+                                              "</leadRecord>"
+                                              "</root>")
+
+        with patch.object(client, "request", side_effect=request):
+            results = list(bulk.iter_leads(client, "email", ["john@doe", "missing", "john@doe"],
+                                           threads=2, processes=2, chunk_size=2))
+
+        self.assertEqual(len(results), 3)
+        self.assertEqual((results[0].id, results[0].email), (100, "john@doe"))
+        self.assertTrue(isinstance(results[1], exceptions.MktLeadNotFound))
+        self.assertEqual((results[2].id, results[2].email), (100, "john@doe"))
+
+    def test_iter_leads_failures(self):
+        client = Client(soap_endpoint="_soap_endpoint_", user_id="_user_id_", encryption_key="_encryption_key_")
+
+        def post(body):
+            if "broken" in body:
+                raise requests.ConnectionError("connection refused")
+            if "garbled" in body:
+                return Mock(status_code=200, text="<root><leadRecord>")
+            return Mock(status_code=200, text="<root><leadRecord><Id>100</Id><Email>john@doe</Email></leadRecord></root>")
+
+        keys = ["john@doe", "broken", "garbled"] * 3
+        with patch.object(client, "post", side_effect=post):
+            results = list(bulk.iter_leads(client, "email", keys, threads=3, processes=2, chunk_size=2))
+
+        self.assertEqual(len(results), 9)
+        for i in range(0, 9, 3):
+            self.assertEqual(results[i].id, 100)
+            self.assertIsInstance(results[i + 1], requests.ConnectionError)
+            self.assertIsInstance(results[i + 2], Exception)
+
+
+class TestExport(unittest.TestCase):
+
+    activity_response = "<root>" \
+                        "<activityRecord>" \
+                        "<id>1</id>" \
+                        "<activityDateTime>2013-01-08T12:31:43Z</activityDateTime>" \
+                        "<activityType>Visit Webpage</activityType>" \
+                        "<activityAttributes>" \
+                        "<attribute>" \
+                        "<attrName>Webpage ID</attrName>" \
+                        "<attrType>integer</attrType>" \
+                        "<attrValue>22</attrValue>" \
+                        "</attribute>" \
+                        "</activityAttributes>" \
+                        "</activityRecord>" \
+                        "</root>"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.client = Client(soap_endpoint="_soap_endpoint_", user_id="_user_id_", encryption_key="_encryption_key_")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_export_lead_activity_ndjson(self):
+        path = os.path.join(self.directory, "out.ndjson")
+        mock_response = Mock(status_code=200, text=self.activity_response)
+        with patch.object(self.client, "request", return_value=mock_response):
+            done = export.export_lead_activity(self.client, ["a@b", "c@d"], path, row_group_size=1, processes=1)
+
+        self.assertEqual(done, 2)
+        with open(path) as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual(rows, [{"lead": "a@b", "id": "1", "type": "Visit Webpage",
+                                 "timestamp": "2013-01-08T12:31:43+00:00", "Webpage ID": 22},
+                                {"lead": "c@d", "id": "1", "type": "Visit Webpage",
+                                 "timestamp": "2013-01-08T12:31:43+00:00", "Webpage ID": 22}])
+
+    def test_export_lead_activity_csv_resume(self):
+        path = os.path.join(self.directory, "out.csv")
+        checkpoint = os.path.join(self.directory, "checkpoint")
+        mock_response = Mock(status_code=200, text=self.activity_response)
+        failed_response = Mock(status_code=500, text="<root><faultstring>Server busy</faultstring></root>")
+
+        with patch.object(self.client, "request", side_effect=[mock_response, failed_response]):
+            self.assertRaises(exceptions.MktException, export.export_lead_activity, self.client, ["a@b", "c@d"],
+                              path, format="csv", row_group_size=1, checkpoint=checkpoint, processes=1)
+        self.assertEqual(export.read_checkpoint(checkpoint), 1)
+
+        with patch.object(self.client, "request", return_value=mock_response) as request:
+            done = export.export_lead_activity(self.client, ["a@b", "c@d"], path, format="csv",
+                                               row_group_size=1, checkpoint=checkpoint, processes=1)
+        self.assertEqual(done, 2)
+        self.assertEqual(request.call_count, 1)
+
+        with open(path) as f:
+            self.assertEqual(f.read().splitlines(), ["lead,id,type,timestamp,Webpage ID",
+                                                     "a@b,1,Visit Webpage,2013-01-08T12:31:43+00:00,22",
+                                                     "c@d,1,Visit Webpage,2013-01-08T12:31:43+00:00,22"])
+
+    def test_export_skips_failed_keys(self):
+        path = os.path.join(self.directory, "out.ndjson")
+        checkpoint = os.path.join(self.directory, "checkpoint")
+        errors = os.path.join(self.directory, "errors.ndjson")
+        mock_response = Mock(status_code=200, text=self.activity_response)
+        bad_parameter = Mock(status_code=500, text="<root><detail><serviceException>"
+                                                   "<message>Bad parameter</message><code>20114</code>"
+                                                   "</serviceException></detail></root>")
+        broken_response = Mock(status_code=200, text="<root><activityRecord>")
+        results = []
+        with patch.object(self.client, "request", side_effect=[mock_response, bad_parameter, broken_response,
+                                                               mock_response]):
+            done = export.export_lead_activity(self.client, ["a@b", "bad", "broken@b", "c@d"], path,
+                                               row_group_size=1, checkpoint=checkpoint, processes=1, threads=1,
+                                               progress=results.append, errors=errors)
+
+        self.assertEqual(done, 4)
+        self.assertEqual(export.read_checkpoint(checkpoint), 4)
+        self.assertTrue(isinstance(results[1], exceptions.MktBadParameter))
+        with open(path) as f:
+            self.assertEqual([json.loads(line)["lead"] for line in f], ["a@b", "c@d"])
+        with open(errors) as f:
+            failed = [json.loads(line) for line in f]
+        self.assertEqual([(each["key"], each["code"]) for each in failed], [("bad", 20114), ("broken@b", None)])
+
+    lead_response = "<root>" \
+                    "<leadRecord>" \
+                    "<Id>100</Id>" \
+                    "<Email>john@doe</Email>" \
+                    "<leadAttributeList>" \
+                    "<attribute><attrName>LeadScore</attrName><attrType>integer</attrType>" \
+                    "<attrValue>20</attrValue></attribute>" \
+                    "<attribute><attrName>Converted</attrName><attrType>datetime</attrType>" \
+                    "<attrValue>2013-01-08T12:31:43-06:00</attrValue></attribute>" \
+                    "<attribute><attrName>City</attrName><attrType>string</attrType>" \
+                    "<attrValue>Oslo</attrValue></attribute>" \
+                    "</leadAttributeList>" \
+                    "</leadRecord>" \
+                    "</root>"
+
+    def export_leads(self, format):
+        path = os.path.join(self.directory, "out." + format)
+        mock_response = Mock(status_code=200, text=self.lead_response)
+        with patch.object(self.client, "request", return_value=mock_response):
+            export.export_leads(self.client, "email", ["john@doe", "john@doe"], path, format=format,
+                                row_group_size=1, processes=1)
+        return path
+
+    def check_table(self, table):
+        self.assertEqual(table.num_rows, 2)
+        self.assertEqual(str(table.column("Converted").type), "timestamp[us, tz=UTC]")
+        self.assertEqual(table.column("id").to_pylist(), [100, 100])
+        self.assertEqual(table.column("LeadScore").to_pylist(), [20, 20])
+        self.assertEqual(table.column("City").to_pylist(), [u"Oslo", u"Oslo"])
+        # microseconds since the epoch of 2013-01-08T18:31:43Z
+        self.assertEqual(table.column("Converted").cast(pyarrow.int64()).to_pylist(), [1357669903000000] * 2)
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_export_leads_parquet(self):
+        import pyarrow.parquet
+        self.check_table(pyarrow.parquet.read_table(self.export_leads("parquet")))
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_export_leads_arrow(self):
+        with open(self.export_leads("arrow"), "rb") as f:
+            self.check_table(pyarrow.ipc.open_stream(f).read_all())
+
+
+class TestListOperation(unittest.TestCase):
+
+    def test_list_operation_wrap(self):
+        self.assertEqual(list_operation.wrap(list_operation.ADD_TO_LIST, "Trade Show", [101, 102]),
+                         u"<mkt:paramsListOperation>"
+                         u"<listOperation>ADDTOLIST</listOperation>"
+                         u"<listKey><keyType>MKTOLISTNAME</keyType><keyValue>Trade Show</keyValue></listKey>"
+                         u"<listMemberList>"
+                         u"<leadKey><keyType>IDNUM</keyType><keyValue>101</keyValue></leadKey>"
+                         u"<leadKey><keyType>IDNUM</keyType><keyValue>102</keyValue></leadKey>"
+                         u"</listMemberList>"
+                         u"<strict>false</strict>"
+                         u"</mkt:paramsListOperation>")
+
+    def test_list_operation_unwrap(self):
+        self.assertEqual(list_operation.unwrap("<root><result><success>true</success><statusList>"
+                                               "<leadStatus><leadKey><keyType>IDNUM</keyType>"
+                                               "<keyValue>101</keyValue></leadKey><status>true</status></leadStatus>"
+                                               "<leadStatus><leadKey><keyType>IDNUM</keyType>"
+                                               "<keyValue>102</keyValue></leadKey><status>false</status></leadStatus>"
+                                               "</statusList></result></root>"),
+                         (True, {"101": True, "102": False}))
+
+    def test_client(self):
+        with emulator.Emulator(user_id="_user_id_", encryption_key="_encryption_key_") as mkto:
+            client = Client(soap_endpoint=mkto.url, user_id="_user_id_", encryption_key="_encryption_key_")
+            ids = [mkto.add_lead("lead%d@doe" % i) for i in range(5)]
+            mkto.add_list("Trade Show", ids[:1])
+
+            statuses = list(bulk.iter_list_operation(client, list_operation.ADD_TO_LIST, "Trade Show", ids + [999],
+                                                     threads=2, chunk_size=2))
+            self.assertEqual(statuses, [(ids[0], False)] + [(each, True) for each in ids[1:]] + [(999, False)])
+            self.assertEqual(mkto.calls["paramsListOperation"], 3)
+
+            self.assertEqual(client.remove_from_list("Trade Show", ["lead0@doe", "lead1@doe"], key_type="email"),
+                             [("lead0@doe", True), ("lead1@doe", True)])
+            self.assertEqual(client.is_member_of_list("Trade Show", ids[:3]),
+                             [(ids[0], False), (ids[1], False), (ids[2], True)])
+
+            statuses = client.add_to_list("Webinar", ids[:2])
+            self.assertEqual([lead for lead, status in statuses], ids[:2])
+            self.assertTrue(all(isinstance(status, exceptions.MktBadParameter) for lead, status in statuses))
+            self.assertRaises(ValueError, client.add_to_list, "", ids)
+
+    def test_missing_and_failed(self):
+        client = Client(soap_endpoint="_soap_endpoint_", user_id="_user_id_", encryption_key="_encryption_key_")
+
+        def call(body, parse):
+            if "broken" in body:
+                raise requests.ConnectionError("connection reset")
+            if "failed" in body:
+                return False, {}
+            # the response lists only the first lead, in another case
+            return True, {"JOHN@DOE": True}
+
+        with patch.object(client, "call", side_effect=call):
+            statuses = list(bulk.iter_list_operation(client, list_operation.IS_MEMBER_OF_LIST, "Trade Show",
+                                                     ["john@doe", "jane@doe", "broken@doe", "joe@doe",
+                                                      "failed@doe"], key_type="email", chunk_size=2))
+        self.assertEqual(statuses[:2], [("john@doe", True), ("jane@doe", None)])
+        self.assertEqual([lead for lead, status in statuses[2:]], ["broken@doe", "joe@doe", "failed@doe"])
+        self.assertTrue(all(isinstance(status, requests.ConnectionError) for lead, status in statuses[2:4]))
+        self.assertTrue(isinstance(statuses[4][1], exceptions.MktException))
+
+    def test_concurrency(self):
+        client = Client(soap_endpoint="_soap_endpoint_", user_id="_user_id_", encryption_key="_encryption_key_")
+
+        def call(body, parse):
+            time.sleep(0.1)
+            return True, {}
+
+        with patch.object(client, "call", side_effect=call):
+            started = time.time()
+            statuses = list(bulk.iter_list_operation(client, list_operation.ADD_TO_LIST, "Trade Show",
+                                                     range(2000), threads=4))
+            elapsed = time.time() - started
+        self.assertEqual(len(statuses), 2000)
+        # 20 calls on 4 threads, draining every group of 5 calls would take 10 rounds
+        self.assertTrue(elapsed < 0.8, elapsed)
+
 
 class TestRequestCampaign(unittest.TestCase):
 
@@ -156,6 +586,96 @@ class TestRequestCampaign(unittest.TestCase):
                          u'</leadList>'
                          u'</mkt:paramsRequestCampaign>')
 
+        # with more leads
+        self.assertEqual(request_campaign.wrap(campaign=1, lead=['2', '3']),
+                         u'<mkt:paramsRequestCampaign>'
+                         u'<source>MKTOWS</source>'
+                         u'<campaignId>1</campaignId>'
+                         u'<leadList>'
+                         u'<leadKey>'
+                         u'<keyType>IDNUM</keyType>'
+                         u'<keyValue>2</keyValue>'
+                         u'</leadKey>'
+                         u'<leadKey>'
+                         u'<keyType>IDNUM</keyType>'
+                         u'<keyValue>3</keyValue>'
+                         u'</leadKey>'
+                         u'</leadList>'
+                         u'</mkt:paramsRequestCampaign>')
+
+    def test_get_campaigns_for_source(self):
+        self.assertEqual(get_campaigns_for_source.wrap(name="Welcome", exact_name=True),
+                         u"<mkt:paramsGetCampaignsForSource>"
+                         u"<source>MKTOWS</source>"
+                         u"<name>Welcome</name><exactName>true</exactName>"
+                         u"</mkt:paramsGetCampaignsForSource>")
+
+        campaigns = get_campaigns_for_source.unwrap("<root><result><returnCount>1</returnCount><campaignRecordList>"
+                                                    "<campaignRecord><id>1190</id><name>Welcome</name>"
+                                                    "<description>Welcome email</description></campaignRecord>"
+                                                    "</campaignRecordList></result></root>")
+        self.assertEqual([(each.id, each.name, each.description) for each in campaigns],
+                         [(1190, "Welcome", "Welcome email")])
+
+    def test_campaign_index(self):
+        with emulator.Emulator(user_id="_user_id_", encryption_key="_encryption_key_") as mkto:
+            client = Client(soap_endpoint=mkto.url, user_id="_user_id_", encryption_key="_encryption_key_",
+                            campaign_ttl=60)
+            lead_id = str(mkto.add_lead("john@doe"))
+            mkto.add_campaign(1190, "Welcome")
+            mkto.add_campaign(1191, "Reminder")
+            mkto.add_campaign(1192, "Reminder")
+
+            self.assertTrue(client.request_campaign("Welcome", lead_id))
+            self.assertTrue(client.request_campaign("Welcome", lead_id))
+            self.assertTrue(client.request_campaign(1190, lead_id))
+            self.assertEqual(mkto.campaign_requests, [(1190, int(lead_id))] * 3)
+            self.assertEqual(mkto.calls["paramsGetCampaignsForSource"], 1)
+
+            # unknown names reload the index, at most once per min_reload seconds
+            mkto.add_campaign(1193, "Goodbye")
+            self.assertRaises(ValueError, client.request_campaign, "Goodbye", lead_id)
+            self.assertEqual(mkto.calls["paramsGetCampaignsForSource"], 1)
+            client.campaigns.loaded -= client.campaigns.min_reload
+            self.assertTrue(client.request_campaign("Goodbye", lead_id))
+            self.assertRaises(ValueError, client.request_campaign, "Missing", lead_id)
+            self.assertRaises(ValueError, client.request_campaign, "Missing", lead_id)
+            self.assertRaises(ValueError, client.request_campaign, "Reminder", lead_id)
+            self.assertEqual(mkto.calls["paramsGetCampaignsForSource"], 2)
+
+            client.campaigns.loaded -= 60
+            self.assertEqual(sorted(each.id for each in client.campaigns.campaigns()), [1190, 1191, 1192, 1193])
+            self.assertEqual(mkto.calls["paramsGetCampaignsForSource"], 3)
+
+    def test_campaign_index_stale(self):
+        client = Client(soap_endpoint="_soap_endpoint_", user_id="_user_id_", encryption_key="_encryption_key_")
+        welcome = get_campaigns_for_source.CampaignRecord()
+        welcome.id, welcome.name = 1190, "Welcome"
+        index = client.campaigns
+
+        # without an index a failed load raises, and keeps raising without a call until min_reload passed
+        with patch.object(client, "get_campaigns", side_effect=requests.ConnectionError("down")) as get_campaigns:
+            self.assertRaises(requests.ConnectionError, index.resolve, "Welcome")
+            self.assertRaises(requests.ConnectionError, index.resolve, "Welcome")
+        self.assertEqual(get_campaigns.call_count, 1)
+        index.retry -= index.min_reload
+        with patch.object(client, "get_campaigns", return_value=[welcome]):
+            self.assertEqual(index.resolve("Welcome"), u"1190")
+
+        # an expired index is served while another thread reloads it
+        index.loaded -= index.ttl
+        with index.lock:
+            with patch.object(client, "get_campaigns", return_value=[]) as get_campaigns:
+                self.assertEqual(index.resolve("Welcome"), u"1190")
+        self.assertEqual(get_campaigns.call_count, 0)
+
+        # and after a failed reload, which is not tried again for min_reload seconds
+        with patch.object(client, "get_campaigns", side_effect=requests.ConnectionError("down")) as get_campaigns:
+            self.assertEqual(index.resolve("Welcome"), u"1190")
+            self.assertEqual(index.resolve("Welcome"), u"1190")
+            self.assertRaises(ValueError, index.resolve, "Goodbye")
+        self.assertEqual(get_campaigns.call_count, 1)
+
 
 class TestSyncLead(unittest.TestCase):
 
@@ -257,6 +777,650 @@ class TestSyncLead(unittest.TestCase):
                          u"<returnLead>true</returnLead>"
                          u"</mkt:paramsSyncLead>")
 
+        # without the lead record in the response
+        self.assertEqual(sync_lead.wrap(marketo_id=101, attributes=(), return_lead=False),
+                         u"<mkt:paramsSyncLead>"
+                         u"<leadRecord>"
+                         u"<Id>101</Id>"
+                         u"<leadAttributeList></leadAttributeList>"
+                         u"</leadRecord>"
+                         u"<returnLead>false</returnLead>"
+                         u"</mkt:paramsSyncLead>")
+
+    def test_sync_lead_unwrap_status(self):
+        self.assertEqual(sync_lead.unwrap_status("<root><result><leadId>101</leadId><syncStatus>"
+                                                 "<leadId>101</leadId><status>UPDATED</status><error/>"
+                                                 "</syncStatus></result></root>"),
+                         (101, "UPDATED", None))
+
+    def test_sync_without_lead(self):
+        with emulator.Emulator(user_id="_user_id_", encryption_key="_encryption_key_") as mkto:
+            client = Client(soap_endpoint=mkto.url, user_id="_user_id_", encryption_key="_encryption_key_")
+            lead_id = mkto.add_lead("john@doe")
+
+            self.assertEqual(client.sync_lead(email="john@doe", attributes=(("City", "string", "Oslo"),),
+                                              return_lead=False),
+                             (lead_id, "UPDATED", None))
+
+            futures = [client.sync_lead_async(email="lead%d@doe" % i, attributes=(("City", "string", "Oslo"),),
+                                              return_lead=False) for i in range(5)]
+            futures.append(client.sync_lead_async(attributes=(("City", "string", "Oslo"),)))
+            client.close()
+            self.assertEqual(sorted(future.result(1)[1] for future in futures[:5]), ["CREATED"] * 5)
+            self.assertIsInstance(futures[5].exception(1), ValueError)
+            self.assertEqual(client.sync_lead_async(email="john@doe", attributes=(("City", "string", "Bergen"),))
+                             .result(5).attributes["City"], "Bergen")
+            client.close()
+
+
+class TestSyncMultipleLeads(unittest.TestCase):
+
+    def test_sync_multiple_leads_wrap(self):
+        self.assertEqual(sync_multiple_leads.wrap([{"marketo_id": 101},
+                                                   {"email": "john@doe", "attributes": (("Age", "integer", "20"),)}]),
+                         u"<mkt:paramsSyncMultipleLeads>"
+                         u"<leadRecordList>"
+                         u"<leadRecord>"
+                         u"<Id>101</Id>"
+                         u"<leadAttributeList></leadAttributeList>"
+                         u"</leadRecord>"
+                         u"<leadRecord>"
+                         u"<Email>john@doe</Email>"
+                         u"<leadAttributeList>"
+                         u"<attribute>"
+                         u"<attrName>Age</attrName>"
+                         u"<attrType>integer</attrType>"
+                         u"<attrValue>20</attrValue>"
+                         u"</attribute>"
+                         u"</leadAttributeList>"
+                         u"</leadRecord>"
+                         u"</leadRecordList>"
+                         u"<dedupEnabled>true</dedupEnabled>"
+                         u"</mkt:paramsSyncMultipleLeads>")
+
+    def test_sync_multiple_leads_unwrap(self):
+        response = "<root>" \
+                   "<syncStatusList>" \
+                   "<syncStatus><leadId>101</leadId><status>UPDATED</status><error/></syncStatus>" \
+                   "<syncStatus><leadId></leadId><status>FAILED</status><error>Bad email</error></syncStatus>" \
+                   "</syncStatusList>" \
+                   "</root>"
+        self.assertEqual(sync_multiple_leads.unwrap(response),
+                         [(101, "UPDATED", None), (None, "FAILED", "Bad email")])
+
+
+class TestCli(unittest.TestCase):
+
+    def test_sync(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "leads.csv")
+            with open(path, "w") as f:
+                f.write("email,LeadScore,City\njohn@doe,20,Toronto\njane@doe,30,\n")
+            mock_response = Mock(status_code=200, text="<root>"
+                                                       "<syncStatus><leadId>1</leadId><status>UPDATED</status></syncStatus>"
+                                                       "<syncStatus><leadId>2</leadId><status>CREATED</status></syncStatus>"
+                                                       "</root>")
+            with patch("marketo.Client.request", return_value=mock_response) as request:
+                with patch("marketo.cli.Progress.show"):
+                    code = cli.main(["--endpoint", "_soap_endpoint_", "--user-id", "_user_id_",
+                                     "--encryption-key", "_encryption_key_",
+                                     "sync", "--input", path, "--attr-type", "LeadScore:integer"])
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(code, 0)
+        self.assertEqual(request.call_count, 1)
+        body = request.call_args[0][0]
+        self.assertTrue(u"<Email>john@doe</Email>"
+                        u"<leadAttributeList>"
+                        u"<attribute><attrName>City</attrName><attrType>string</attrType><attrValue>Toronto</attrValue></attribute>"
+                        u"<attribute><attrName>LeadScore</attrName><attrType>integer</attrType><attrValue>20</attrValue></attribute>"
+                        u"</leadAttributeList>" in body, body)
+        self.assertTrue(u"<Email>jane@doe</Email>"
+                        u"<leadAttributeList>"
+                        u"<attribute><attrName>LeadScore</attrName><attrType>integer</attrType><attrValue>30</attrValue></attribute>"
+                        u"</leadAttributeList>" in body, body)
+
+    def test_sync_batch_failures(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "leads.csv")
+            with open(path, "w") as f:
+                # the second row is short, the third has a field too many
+                f.write("email,LeadScore,City\njohn@doe,20,Toronto\njane@doe,30\njim@doe,40,Oslo,extra\njoe@doe,50,\n")
+            ok_response = Mock(status_code=200, text="<root>"
+                                                     "<syncStatus><leadId>1</leadId><status>UPDATED</status></syncStatus>"
+                                                     "</root>")
+            responses = [requests.ConnectionError("connection refused"), ok_response, ok_response, ok_response]
+            with patch("marketo.Client.request", side_effect=responses) as request:
+                with patch("marketo.cli.Progress.show"):
+                    with patch("sys.stderr"):
+                        code = cli.main(["--endpoint", "_soap_endpoint_", "--user-id", "_user_id_",
+                                         "--encryption-key", "_encryption_key_", "--batch-size", "1",
+                                         "--concurrency", "1", "sync", "--input", path])
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(request.call_count, 4)
+        self.assertEqual(code, 1)
+        bodies = [each[0][0] for each in request.call_args_list]
+        self.assertTrue(u"<Email>jane@doe</Email>"
+                        u"<leadAttributeList>"
+                        u"<attribute><attrName>LeadScore</attrName><attrType>string</attrType><attrValue>30</attrValue></attribute>"
+                        u"</leadAttributeList>" in bodies[1], bodies[1])
+        self.assertTrue(u"<attrValue>Oslo</attrValue>" in bodies[2] and u"extra" not in bodies[2], bodies[2])
+
+    def test_row_group_size(self):
+        common = ["--endpoint", "_soap_endpoint_", "--user-id", "_user_id_", "--encryption-key", "_encryption_key_"]
+        args = cli.parser().parse_args(common + ["get", "--input", "leads.csv", "--output", "leads.ndjson"])
+        self.assertEqual((args.batch_size, args.row_group_size), (100, export.ROW_GROUP_SIZE))
+        args = cli.parser().parse_args(common + ["--batch-size", "300", "activity", "--input", "leads.csv",
+                                                 "--output", "activities.parquet", "--row-group-size", "50000"])
+        self.assertEqual((args.batch_size, args.row_group_size), (300, 50000))
+
+
+class TestSchema(unittest.TestCase):
+
+    def test_describe_mobject(self):
+        self.assertEqual(describe_mobject.wrap(),
+                         u"<ns1:paramsDescribeMObject>"
+                         u"<objectName>LeadRecord</objectName>"
+                         u"</ns1:paramsDescribeMObject>")
+
+        fields = describe_mobject.unwrap("<root><result><metadata><fieldList>"
+                                         "<field><name>Id</name><dataType>integer</dataType>"
+                                         "<size xsi:nil='true' xmlns:xsi='http://www.w3.org/2001/XMLSchema-instance'/>"
+                                         "<isReadonly>true</isReadonly></field>"
+                                         "<field><name>FirstName</name><displayName>First Name</displayName>"
+                                         "<dataType>string</dataType><size>255</size>"
+                                         "<isReadonly>false</isReadonly><isCustom>false</isCustom></field>"
+                                         "</fieldList></metadata></result></root>")
+        self.assertEqual([(each.name, each.data_type, each.size, each.readonly) for each in fields],
+                         [("Id", "integer", None, True), ("FirstName", "string", 255, False)])
+        self.assertEqual(fields[1].display_name, "First Name")
+
+    def test_attributes(self):
+        lead_schema = schema.LeadSchema(describe_mobject.unwrap(
+            "<root><fieldList>"
+            "<field><name>Id</name><dataType>integer</dataType><isReadonly>true</isReadonly></field>"
+            "<field><name>FirstName</name><dataType>string</dataType></field>"
+            "<field><name>LeadScore</name><dataType>integer</dataType></field>"
+            "</fieldList></root>"))
+
+        self.assertEqual(lead_schema.attributes([("FirstName", "John"), ("LeadScore", "string", 10)]),
+                         [("FirstName", "string", "John"), ("LeadScore", "string", 10)])
+        self.assertEqual(lead_schema.attributes({"LeadScore": "20"}), [("LeadScore", "integer", "20")])
+
+        with self.assertRaises(exceptions.MktUnknownLeadField) as context:
+            lead_schema.attributes([("Nickname", "Johnny")])
+        self.assertEqual(context.exception.code, 20105)
+        self.assertRaises(exceptions.MktBadParameter, lead_schema.attributes, [("Id", 10)])
+        self.assertRaises(exceptions.MktBadParameter, lead_schema.attributes, [("LeadScore", "high")])
+
+    def test_client(self):
+        with emulator.Emulator(user_id="_user_id_", encryption_key="_encryption_key_",
+                               fields={"FirstName": "string", "LeadScore": "integer"}) as mkto:
+            client = Client(soap_endpoint=mkto.url, user_id="_user_id_", encryption_key="_encryption_key_",
+                            schema_ttl=60)
+
+            lead = client.sync_lead(email="john@doe", attributes=[("FirstName", "John"), ("LeadScore", 10)])
+            self.assertEqual(lead.attributes, {"FirstName": "John", "LeadScore": 10})
+            self.assertEqual(lead.attribute_types, {"FirstName": "string", "LeadScore": "integer"})
+
+            self.assertRaises(exceptions.MktUnknownLeadField, client.sync_lead, email="john@doe",
+                              attributes=[("Nickname", "Johnny")])
+            statuses = client.sync_multiple_leads([{"email": "jane@doe", "attributes": [("Nickname", "Jane")]},
+                                                   {"email": "john@doe", "attributes": {"LeadScore": 20}}])
+            self.assertEqual(statuses, [(None, "FAILED", "Field 'Nickname' not found"),
+                                        (lead.id, "UPDATED", None)])
+            self.assertEqual(client.sync_multiple_leads([{"email": "jane@doe", "attributes": {"Id": 1}}]),
+                             [(None, "FAILED", "Field 'Id' is read only")])
+
+            # the schema is fetched once and the rejected leads never reach Marketo
+            self.assertEqual(mkto.calls, {"paramsDescribeMObject": 1, "paramsSyncLead": 1,
+                                          "paramsSyncMultipleLeads": 1})
+
+            client.schema.fetched -= 60
+            client.sync_lead(email="john@doe", attributes={"LeadScore": 30})
+            self.assertEqual(mkto.calls["paramsDescribeMObject"], 2)
+
+
+class TestEmulator(unittest.TestCase):
+
+    def setUp(self):
+        self.emulator = emulator.Emulator(user_id="_user_id_", encryption_key="_encryption_key_").start()
+        self.client = Client(soap_endpoint=self.emulator.url, user_id="_user_id_", encryption_key="_encryption_key_")
+
+    def tearDown(self):
+        self.emulator.stop()
+
+    def test_leads(self):
+        lead_id = self.emulator.add_lead("john@doe", {"FirstName": ("string", "John"), "LeadScore": ("integer", "20")})
+
+        lead = self.client.get_lead(email="john@doe")
+        self.assertEqual((lead.id, lead.email), (lead_id, "john@doe"))
+        self.assertEqual(lead.attributes, {"FirstName": "John", "LeadScore": 20})
+        self.assertRaises(exceptions.MktLeadNotFound, self.client.get_lead, email="jane@doe")
+
+        lead = self.client.sync_lead(email="john@doe", attributes=(("FirstName", "string", "Johnny"),))
+        self.assertEqual(lead.id, lead_id)
+        self.assertEqual(lead.attributes["FirstName"], "Johnny")
+
+        statuses = self.client.sync_multiple_leads([{"email": "john@doe", "attributes": (("City", "string", "Oslo"),)},
+                                                    {"email": "jane@doe"}])
+        self.assertEqual(statuses, [(lead_id, "UPDATED", None), (lead_id + 1, "CREATED", None)])
+
+        activities = self.client.get_lead_activity(email="john@doe", activity_types=["Change Data Value"])
+        self.assertEqual([each.attributes["New Value"] for each in activities], ["Oslo", "Johnny"])
+
+    def test_request_campaign(self):
+        lead_id = self.emulator.add_lead("john@doe")
+        self.emulator.add_campaign(1190, "Welcome")
+        self.assertTrue(self.client.request_campaign("1190", str(lead_id)))
+        self.assertEqual(self.emulator.campaign_requests, [(1190, lead_id)])
+
+    def test_faults(self):
+        client = Client(soap_endpoint=self.emulator.url, user_id="_user_id_", encryption_key="_wrong_key_")
+        self.assertRaises(exceptions.MktAuthenticationFailed, client.get_lead, email="john@doe")
+
+        self.emulator.quota = 1
+        self.emulator.add_lead("john@doe")
+        self.client.get_lead(email="john@doe")
+        self.assertRaises(exceptions.MktRequestLimitExceeded, self.client.get_lead, email="john@doe")
+
+    def test_retries(self):
+        self.emulator.add_lead("john@doe")
+        self.emulator.error_rate = 0.5
+        self.emulator.random.seed(1)
+        client = Client(soap_endpoint=self.emulator.url, user_id="_user_id_", encryption_key="_encryption_key_",
+                        retries=10, backoff=0)
+        for _ in range(5):
+            self.assertEqual(client.get_lead(email="john@doe").email, "john@doe")
+
+    def test_faults_parsed_once(self):
+        unwrap = exceptions.unwrap
+        for retries in (0, 1):
+            client = Client(soap_endpoint=self.emulator.url, user_id="_user_id_", encryption_key="_encryption_key_",
+                            retries=retries, backoff=0)
+            with patch("marketo.exceptions.unwrap", side_effect=unwrap) as parsed:
+                self.assertRaises(exceptions.MktLeadNotFound, client.get_lead, email="jane@doe")
+            self.assertEqual(parsed.call_count, 1)
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_operation(self):
+        self.assertEqual(instrument.operation(get_lead.wrap("email", "john@doe")), "getLead")
+        self.assertEqual(instrument.operation(request_campaign.wrap("1", "2")), "requestCampaign")
+
+    def test_histogram(self):
+        metrics = instrument.HistogramInstrumentation()
+        with emulator.Emulator(user_id="_user_id_", encryption_key="_encryption_key_") as mkto:
+            mkto.add_lead("john@doe")
+            client = Client(soap_endpoint=mkto.url, user_id="_user_id_", encryption_key="_encryption_key_",
+                            instrumentation=metrics)
+            client.get_lead(email="john@doe")
+            client.get_lead_activity(email="john@doe")
+            self.assertRaises(exceptions.MktLeadNotFound, client.get_lead, email="jane@doe")
+
+        self.assertEqual(metrics.counters["getLead"]["calls"], 2)
+        self.assertEqual(metrics.counters["getLead"]["records"], 1)
+        self.assertEqual(metrics.counters["getLead"]["fault:20103"], 1)
+        self.assertEqual(metrics.counters["getLeadActivity"]["records"], 1)
+        self.assertTrue(metrics.counters["getLead"]["request_bytes"] > 0)
+        self.assertTrue(metrics.counters["getLead"]["response_bytes"] > 0)
+        for phase in instrument.PHASES:
+            self.assertEqual(metrics.histogram("getLead", phase).count, 2)
+        self.assertTrue(metrics.histogram("getLead", "network").percentile(0.5) > 0)
+
+        exposition = metrics.prometheus()
+        self.assertTrue('marketo_phase_seconds_count{operation="getLead",phase="network"} 2' in exposition)
+        self.assertTrue('marketo_faults_total{operation="getLead",code="20103"} 1' in exposition)
+
+    def test_bulk(self):
+        metrics = instrument.HistogramInstrumentation()
+        with emulator.Emulator(user_id="_user_id_", encryption_key="_encryption_key_") as mkto:
+            mkto.add_lead("john@doe")
+            mkto.add_lead("jane@doe")
+            client = Client(soap_endpoint=mkto.url, user_id="_user_id_", encryption_key="_encryption_key_",
+                            instrumentation=metrics)
+            list(bulk.iter_leads(client, "email", ["john@doe", "jane@doe", "joe@doe"], threads=2, processes=1))
+            client.get_lead_activity_bulk(["john@doe", "jane@doe"], threads=2, processes=1)
+
+        self.assertEqual(metrics.counters["getLead"]["calls"], 3)
+        self.assertEqual(metrics.counters["getLead"]["records"], 2)
+        self.assertEqual(metrics.counters["getLead"]["fault:20103"], 1)
+        self.assertEqual(metrics.counters["getLeadActivity"]["records"], 2)
+        self.assertEqual(metrics.histogram("getLead", "network").count, 3)
+        self.assertTrue(metrics.histogram("getLeadActivity", "parse").sum > 0)
+
+    def test_statsd(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(("127.0.0.1", 0))
+        server.settimeout(5)
+        statsd = instrument.StatsdInstrumentation(port=server.getsockname()[1])
+        event = instrument.Event("getLead")
+        event.fault = 20103
+        statsd.emit(event)
+        lines = server.recv(65536).split("\n")
+        server.close()
+        self.assertTrue("marketo.getLead.calls:1|c" in lines)
+        self.assertTrue("marketo.getLead.faults.20103:1|c" in lines)
+        self.assertTrue("marketo.getLead.network:0.000|ms" in lines)
+
+
+class TestAdaptiveLimiter(unittest.TestCase):
+
+    def test_aimd(self):
+        limiter = throttle.AdaptiveLimiter(initial=2, max_limit=4)
+        self.assertTrue(limiter.try_acquire())
+        self.assertTrue(limiter.try_acquire())
+        self.assertFalse(limiter.try_acquire())
+        limiter.release(0.1)
+        limiter.release(0.1)
+        self.assertEqual(limiter.in_flight, 0)
+
+        # flat latency grows the limit up to its maximum
+        for _ in range(20):
+            limiter.acquire()
+            limiter.release(0.1)
+        self.assertEqual(limiter.limit, 4)
+
+        # a quota fault halves it
+        limiter.acquire()
+        limiter.release(None, overloaded=True)
+        self.assertEqual(limiter.limit, 2)
+
+        # so does a run of slow responses, more gently
+        limiter.acquire()
+        limiter.release(1.0)
+        self.assertEqual(limiter.limit, 1.8)
+
+    def test_callback(self):
+        limiter = throttle.AdaptiveLimiter(initial=1)
+        woken = []
+        self.assertTrue(limiter.try_acquire())
+        self.assertFalse(limiter.try_acquire(lambda: woken.append(1)))
+        self.assertFalse(limiter.try_acquire())
+        self.assertEqual(woken, [])
+
+        # the released slot is handed to the queued callback
+        limiter.release(0.1)
+        self.assertEqual(woken, [1])
+        self.assertEqual(limiter.in_flight, 1)
+        limiter.release(0.1)
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_client_quota(self):
+        limiter = throttle.AdaptiveLimiter(initial=8)
+        with emulator.Emulator(user_id="_user_id_", encryption_key="_encryption_key_", quota=1) as mkto:
+            mkto.add_lead("john@doe")
+            client = Client(soap_endpoint=mkto.url, user_id="_user_id_", encryption_key="_encryption_key_",
+                            limiter=limiter)
+            client.get_lead(email="john@doe")
+            self.assertEqual(client.concurrency_limit, 8)
+            self.assertRaises(exceptions.MktRequestLimitExceeded, client.get_lead, email="john@doe")
+        self.assertEqual(client.concurrency_limit, 4)
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_client_timeout(self):
+        limiter = throttle.AdaptiveLimiter(initial=8)
+        with emulator.Emulator(user_id="_user_id_", encryption_key="_encryption_key_", latency=0.5) as mkto:
+            mkto.add_lead("john@doe")
+            client = Client(soap_endpoint=mkto.url, user_id="_user_id_", encryption_key="_encryption_key_",
+                            limiter=limiter, timeout=0.1)
+            self.assertRaises(requests.Timeout, client.get_lead, email="john@doe")
+        self.assertEqual(client.concurrency_limit, 4)
+        self.assertEqual(limiter.in_flight, 0)
+
+
+class TestFuture(unittest.TestCase):
+
+    def test_run(self):
+        done = []
+        ok = future.Future()
+        ok.add_done_callback(done.append)
+        future.run(ok, sum, [1, 2])
+        self.assertEqual((ok.result(1), done), (3, [ok]))
+
+        failed = future.Future()
+        future.run(failed, int, "x")
+        self.assertTrue(isinstance(failed.exception(1), ValueError))
+        self.assertRaises(ValueError, failed.result, 1)
+        self.assertRaises(RuntimeError, future.Future().result, 0.01)
+        self.assertTrue(pool.Future is future.Future)
+
+
+class TestClientPool(unittest.TestCase):
+
+    def test_tenants(self):
+        with emulator.Emulator(user_id="acme", encryption_key="_acme_key_") as acme:
+            with emulator.Emulator(user_id="globex", encryption_key="_globex_key_") as globex:
+                acme.add_lead("john@acme")
+                globex.add_lead("jane@globex")
+                with pool.ClientPool(workers=4) as clients:
+                    clients.add("acme", acme.url, "acme", "_acme_key_")
+                    clients.add("globex", globex.url, "globex", "_globex_key_")
+                    self.assertTrue(clients.client("acme").session is clients.client("globex").session)
+
+                    john = clients.submit("acme", "get_lead", email="john@acme")
+                    jane = clients.submit_bulk("globex", "get_lead", email="jane@globex")
+                    missing = clients.submit("globex", lambda client: client.get_lead(email="john@acme"))
+                    self.assertEqual(john.result(5).email, "john@acme")
+                    self.assertEqual(jane.result(5).email, "jane@globex")
+                    self.assertRaises(exceptions.MktLeadNotFound, missing.result, 5)
+
+    def test_fair_scheduling(self):
+        clients = pool.ClientPool(workers=1)
+        try:
+            clients.add("backfill", "_soap_endpoint_", "_user_id_", "_encryption_key_")
+            clients.add("interactive", "_soap_endpoint_", "_user_id_", "_encryption_key_")
+            order = []
+            gate = threading.Event()
+            blocker = clients.submit_bulk("backfill", lambda client: gate.wait(5))
+            for i in range(3):
+                clients.submit_bulk("backfill", lambda client, i=i: order.append(("backfill", i)))
+            lookup = clients.submit("interactive", lambda client: order.append(("interactive", 0)))
+            gate.set()
+            blocker.result(5)
+            lookup.result(5)
+        finally:
+            clients.close()
+        self.assertEqual(order[0], ("interactive", 0))
+        self.assertEqual(len(order), 4)
+
+    def test_rate_limited_tenants(self):
+        with emulator.Emulator(user_id="_user_id_", encryption_key="_encryption_key_") as mkto:
+            mkto.add_lead("john@doe")
+            with pool.ClientPool(workers=4) as clients:
+                futures = []
+                for tenant in ("a", "b", "c", "d"):
+                    clients.add(tenant, mkto.url, "_user_id_", "_encryption_key_", rate_limit=1)
+                    futures.extend(clients.submit_bulk(tenant, "get_lead", email="john@doe") for _ in range(3))
+                clients.add("interactive", mkto.url, "_user_id_", "_encryption_key_")
+
+                # the throttled backfills leave the workers free for other tenants
+                threading.Event().wait(0.2)
+                started = time.time()
+                self.assertEqual(clients.submit("interactive", "get_lead", email="john@doe").result(5).email,
+                                 "john@doe")
+                self.assertTrue(time.time() - started < 0.5)
+                self.assertFalse(all(future.done() for future in futures))
+
+                for future in futures:
+                    self.assertEqual(future.result(10).email, "john@doe")
+
+    def test_concurrency_cap(self):
+        clients = pool.ClientPool(workers=4)
+        try:
+            clients.add("acme", "_soap_endpoint_", "_user_id_", "_encryption_key_", max_concurrency=1)
+            running = []
+            peak = []
+            lock = threading.Lock()
+
+            def work(client):
+                with lock:
+                    running.append(1)
+                    peak.append(len(running))
+                threading.Event().wait(0.01)
+                with lock:
+                    running.pop()
+
+            futures = [clients.submit("acme", work) for _ in range(5)]
+            for future in futures:
+                future.result(5)
+        finally:
+            clients.close()
+        self.assertEqual(max(peak), 1)
+
+
+class TestShardedDispatcher(unittest.TestCase):
+
+    def test_shard_key(self):
+        self.assertEqual(shard.shard_key(email="John@Doe", marketo_cookie="abc"), u"email:john@doe")
+        self.assertEqual(shard.shard_key(marketo_id=101, email="john@doe"), u"marketo_id:101")
+        self.assertRaises(ValueError, shard.shard_key, attributes=())
+        self.assertEqual(shard.shard_of(u"email:john@doe", 8), shard.shard_of(u"email:john@doe", 8))
+
+    def test_order_per_lead(self):
+        applied = []
+
+        class RecordingClient:
+            def sync_lead(self, email=None, attributes=None):
+                threading.Event().wait(0.001)
+                applied.append((email, attributes[0][2]))
+                return email
+
+        with shard.ShardedDispatcher(RecordingClient(), shards=4, max_pending=2) as dispatcher:
+            futures = [dispatcher.submit(email="lead%d@doe" % (i % 5), attributes=(("Seq", "integer", i),))
+                       for i in range(40)]
+        self.assertEqual([future.result(5) for future in futures], ["lead%d@doe" % (i % 5) for i in range(40)])
+        for lead in range(5):
+            sequence = [seq for email, seq in applied if email == "lead%d@doe" % lead]
+            self.assertEqual(sequence, sorted(sequence))
+            self.assertEqual(len(sequence), 8)
+
+    def test_processes(self):
+        with emulator.Emulator(user_id="_user_id_", encryption_key="_encryption_key_") as mkto:
+            client = Client(soap_endpoint=mkto.url, user_id="_user_id_", encryption_key="_encryption_key_")
+            with shard.ShardedDispatcher(client, shards=2, processes=True) as dispatcher:
+                futures = [dispatcher.submit(email="john@doe", attributes=(("Seq", "integer", i),)) for i in range(5)]
+                failed = dispatcher.submit(marketo_id=999, attributes=(("Seq", "integer", 0),))
+            self.assertEqual(mkto.leads.values()[0].attributes["Seq"], ("integer", "4"))
+        self.assertEqual([future.result(5).email for future in futures], ["john@doe"] * 5)
+        self.assertRaises(exceptions.MktLeadNotFound, failed.result, 5)
+
+    def test_processes_unpicklable_results(self):
+        class Unloadable(Exception):
+            def __init__(self, reason):
+                Exception.__init__(self)
+
+        def sync_lead(email=None, attributes=None):
+            if email == "lock@doe":
+                return threading.Lock()
+            if email == "error@doe":
+                raise Unloadable("no arguments to unpickle with")
+            return email
+
+        client = Client(soap_endpoint="http://localhost", user_id="_user_id_", encryption_key="_encryption_key_",
+                        rate_limit=5)
+        with patch.object(Client, "sync_lead", side_effect=sync_lead):
+            with shard.ShardedDispatcher(client, shards=2, processes=True) as dispatcher:
+                lock = dispatcher.submit(email="lock@doe")
+                error = dispatcher.submit(email="error@doe")
+                ok = dispatcher.submit(email="john@doe")
+        self.assertRaises(RuntimeError, lock.result, 5)
+        self.assertRaises(RuntimeError, error.result, 5)
+        self.assertEqual(ok.result(5), "john@doe")
+
+    def test_process_settings(self):
+        limiter = throttle.AdaptiveLimiter(initial=8, max_limit=16)
+        client = Client(soap_endpoint="http://localhost", user_id="_user_id_", encryption_key="_encryption_key_",
+                        rate_limit=5, limiter=limiter, timeout=30)
+        settings = shard._settings(client)
+        self.assertEqual(settings["rate_limit"], 5)
+        self.assertEqual(settings["timeout"], 30)
+        self.assertIsNot(settings["limiter"], limiter)
+        self.assertEqual((settings["limiter"].limit, settings["limiter"].max_limit), (8, 16))
+        Client(**settings)
+
+
+class TestSerial(unittest.TestCase):
+
+    def test_round_trip(self):
+        lead = get_lead.unwrap("<root>"
+                               "<leadRecord>"
+                               "<Id>101</Id>"
+                               "<Email>john@doe.com</Email>"
+                               "<leadAttributeList>"
+                               "<attribute><attrName>Name</attrName><attrType>string</attrType>"
+                               "<attrValue>John Doe, a h\xc5\x91s</attrValue></attribute>"
+                               "<attribute><attrName>Age</attrName><attrType>integer</attrType>"
+                               "<attrValue>20</attrValue></attribute>"
+                               "<attribute><attrName>Phone</attrName><attrType>phone</attrType><attrValue/></attribute>"
+                               "</leadAttributeList>"
+                               "</leadRecord>"
+                               "</root>")
+        activities = get_lead_changes.unwrap("<root>"
+                                             "<leadChangeRecord>"
+                                             "<id>1</id>"
+                                             "<activityDateTime>2013-01-08T12:31:43-06:00</activityDateTime>"
+                                             "<activityType>Change Data Value</activityType>"
+                                             "<activityAttributes>"
+                                             "<attribute><attrName>Age</attrName><attrType>integer</attrType>"
+                                             "<attrValue>21</attrValue></attribute>"
+                                             "</activityAttributes>"
+                                             "<mktPersonId>101</mktPersonId>"
+                                             "</leadChangeRecord>"
+                                             "</root>")[0]
+        records = [lead, activities[0], lead]
+
+        data = serial.dumps(records)
+        self.assertEqual(data.count("Age"), 1)
+
+        restored = serial.loads(data)
+        self.assertEqual([each.__dict__ for each in restored], [each.__dict__ for each in records])
+        self.assertEqual(restored[1].timestamp.isoformat(), "2013-01-08T12:31:43-06:00")
+        self.assertEqual(restored[0].attributes["Name"], u"John Doe, a h\u0151s")
+
+    def test_streaming(self):
+        stream = cStringIO.StringIO()
+        writer = serial.Writer(stream)
+        for i in range(3):
+            lead = get_lead.unwrap("<root><leadRecord><Id>%d</Id><Email>lead%d@doe</Email></leadRecord></root>" % (i, i))
+            writer.write(lead)
+        stream.seek(0)
+        self.assertEqual([(each.id, each.email) for each in serial.Reader(stream)],
+                         [(0, "lead0@doe"), (1, "lead1@doe"), (2, "lead2@doe")])
+        self.assertRaises(ValueError, serial.Reader, cStringIO.StringIO("not a stream"))
+
+        # string table indexes and string values past the one byte varint range
+        wide = get_lead.unwrap("<root><leadRecord><Id>1</Id><Email>wide@doe</Email><leadAttributeList>%s"
+                               "</leadAttributeList></leadRecord></root>" %
+                               "".join("<attribute><attrName>Field%d</attrName><attrType>string</attrType>"
+                                       "<attrValue>%s</attrValue></attribute>" % (i, "x" * i) for i in range(1, 200)))
+        restored = serial.loads(serial.dumps([wide]))[0]
+        self.assertEqual((restored.attributes, restored.attribute_types), (wide.attributes, wide.attribute_types))
+
+        # a stream cut inside the length or the payload of a frame
+        data = stream.getvalue()
+        for end in (len(serial.MAGIC) + 1, len(data) - 1):
+            reader = serial.Reader(cStringIO.StringIO(data[:end]))
+            self.assertRaises(ValueError, list, reader)
+
+
+class TestBenchmarkPayloads(unittest.TestCase):
+
+    def test_payloads_parse(self):
+        import benchmark
+
+        lead = get_lead.unwrap(benchmark.lead_response(150))
+        self.assertEqual(len(lead.attributes), 150)
+        activities = get_lead_activity.unwrap(benchmark.activity_response(10))
+        self.assertEqual(len(activities), 10)
+        self.assertEqual(len(activities[0].attributes), 8)
+
 
 class TestClient(unittest.TestCase):
 
@@ -323,6 +1487,42 @@ class TestClient(unittest.TestCase):
         self.assertEqual(lead.id, 100)
         self.assertEqual(lead.email, "john@doe")
 
+    def test_get_lead_activity_with_filters(self):
+        client = Client(soap_endpoint="_soap_endpoint_", user_id="_user_id_", encryption_key="_encryption_key_")
+        mock_response = Mock(status_code=200, text="<root/>")
+        with patch.object(client, "request", return_value=mock_response) as request:
+            self.assertEqual(client.get_lead_activity(idnum=384563, activity_types=["Click Link"]), [])
+        body = request.call_args[0][0]
+        self.assertTrue(u"<keyType>IDNUM</keyType><keyValue>384563</keyValue>" in body, body)
+        self.assertTrue(u"<includeTypes><activityType>Click Link</activityType></includeTypes>" in body, body)
+
+        self.assertRaises(ValueError, client.get_lead_activity)
+        self.assertRaises(ValueError, client.get_lead_activity, email="john@doe", idnum=1)
+
+    def test_request_retries_transient_faults(self):
+        client = Client(soap_endpoint="_soap_endpoint_", user_id="_user_id_", encryption_key="_encryption_key_",
+                        retries=2, backoff=0)
+        busy_response = Mock(status_code=500, text="<root>"
+                                                   "<detail>"
+                                                   "<message>Request limit exceeded (20015)</message>"
+                                                   "<code>20015</code>"
+                                                   "</detail>"
+                                                   "</root>")
+        mock_response = Mock(status_code=200, text="<root/>")
+        with patch.object(client, "post", side_effect=[busy_response, mock_response]) as post:
+            self.assertEqual(client.request("<body/>"), mock_response)
+        self.assertEqual(post.call_count, 2)
+
+        not_found_response = Mock(status_code=500, text="<root>"
+                                                        "<detail>"
+                                                        "<message>No lead found with IDNUM = 1 (20103)</message>"
+                                                        "<code>20103</code>"
+                                                        "</detail>"
+                                                        "</root>")
+        with patch.object(client, "post", return_value=not_found_response) as post:
+            self.assertEqual(client.request("<body/>"), not_found_response)
+        self.assertEqual(post.call_count, 1)
+
 
 if __name__ == '__main__':
     unittest.main()